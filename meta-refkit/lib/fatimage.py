@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+#
+# Creates populated FAT16/FAT32 file systems without mkdosfs and mtools.
+#
+# The complete layout (boot sector, FATs, directories, which cluster
+# holds what) gets computed in memory first. Then the file system gets
+# written in a single sequential pass, skipping unused areas so that
+# the output stays sparse. The same layout can be written several
+# times, for example for primary and secondary UEFI partitions, with
+# different volume ID and label.
+#
+# Used by image-dsk.py, which runs with Python 2, so this must work
+# with both Python 2 and 3.
+#
+# Copyright (C) 2017 Intel Corporation
+# Licensed under the MIT license
+
+import hashlib
+import os
+import stat
+import struct
+import time
+from uuid import uuid4
+
+SECTOR_SIZE = 512
+DIR_ENTRY_SIZE = 32
+ATTR_READ_ONLY = 0x01
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0f
+
+# Offsets of the volume ID in the boot sector.
+VOLUME_ID_OFFSET = {16: 39, 32: 67}
+# Offset of the number of sectors before the file system.
+HIDDEN_SECTORS_OFFSET = 28
+# FAT32 keeps a backup of the boot sector in this sector.
+BACKUP_BOOT_SECTOR = 6
+
+# Characters allowed in short (8.3) names, besides letters and digits.
+SHORT_NAME_CHARS = set("$%'-_@~`!(){}^#&")
+
+
+def fat_timestamp(mtime):
+    """Return FAT (date, time) for a time stamp, in UTC."""
+    tm = time.gmtime(max(mtime, 315532800))  # 1980-01-01
+    if tm.tm_year > 2107:
+        tm = time.gmtime(4354819198)  # 2107-12-31 23:59:58
+    return (((tm.tm_year - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday,
+            (tm.tm_hour << 11) | (tm.tm_min << 5) | (tm.tm_sec // 2))
+
+
+def short_name_checksum(short_name):
+    """Checksum of an 11 byte short name, stored in long name entries."""
+    checksum = 0
+    for c in bytearray(short_name):
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + c) & 0xff
+    return checksum
+
+
+def to_unicode(name):
+    """File names are bytes in Python 2 and str in Python 3."""
+    if isinstance(name, bytes):
+        return name.decode('utf-8')
+    return name
+
+
+def short_name_part(part):
+    """Upper case version of part with invalid characters replaced."""
+    return ''.join([c if c.isalnum() and ord(c) < 128 or c in SHORT_NAME_CHARS
+                    else '_' for c in part.upper().replace(' ', '')])
+
+
+def split_name(name):
+    """Split into base and extension at the last dot, like 8.3 names."""
+    if '.' in name.lstrip('.'):
+        base, ext = name.rsplit('.', 1)
+        return base, ext
+    return name, ''
+
+
+def short_names(name, used):
+    """Return (short name, needs long name) for a file name.
+
+    Names which are valid upper case 8.3 names get stored as they are,
+    everything else and names whose short name is already in used get a
+    unique numeric-tail short name ("BOOTX6~1.EFI") plus long name
+    entries. Short names get added to used.
+    """
+    base, ext = split_name(name)
+    if len(base) <= 8 and len(ext) <= 3 and \
+            short_name_part(base) == base and short_name_part(ext) == ext:
+        short = (base.ljust(8) + ext.ljust(3)).encode('ascii')
+        if short not in used:
+            used.add(short)
+            return short, False
+    base = short_name_part(base).lstrip('.')
+    ext = short_name_part(ext)[:3]
+    if len(base) <= 8 and len(ext) <= 3 and \
+            base.lower() + ('.' + ext.lower() if ext else '') == name.lower():
+        # Only the case differs, keep the name without numeric tail
+        # unless some other name already has it.
+        short = (base.ljust(8) + ext.ljust(3)).encode('ascii')
+        if short not in used:
+            used.add(short)
+            return short, True
+    for number in range(1, 1000000):
+        tail = '~%d' % number
+        short = ((base[:8 - len(tail)] + tail).ljust(8) +
+                 ext.ljust(3)).encode('ascii')
+        if short not in used:
+            used.add(short)
+            return short, True
+    raise ValueError('%s: too many similar names' % name)
+
+
+def dir_entry(short_name, attr, cluster, size, mtime):
+    """Pack a short directory entry."""
+    date, tm = fat_timestamp(mtime)
+    return struct.pack('<11sBBBHHHHHHHI', short_name, attr, 0, 0, tm, date,
+                       date, cluster >> 16, tm, date, cluster & 0xffff, size)
+
+
+def long_name_entries(name, short_name):
+    """Pack the long name entries which precede a short entry."""
+    encoded = name.encode('utf-16-le')
+    chars = [encoded[i:i + 2] for i in range(0, len(encoded), 2)]
+    if len(chars) > 255:
+        raise ValueError('%s: name too long for FAT' % name)
+    if len(chars) % 13:
+        chars.append(b'\0\0')
+    while len(chars) % 13:
+        chars.append(b'\xff\xff')
+    checksum = short_name_checksum(short_name)
+    entries = []
+    count = len(chars) // 13
+    for seq in range(1, count + 1):
+        part = chars[(seq - 1) * 13:seq * 13]
+        entries.append(struct.pack('<B10sBBB12sH4s',
+                                   seq | (0x40 if seq == count else 0),
+                                   b''.join(part[0:5]), ATTR_LONG_NAME, 0,
+                                   checksum, b''.join(part[5:11]), 0,
+                                   b''.join(part[11:13])))
+    entries.reverse()
+    return entries
+
+
+class Node(object):
+    """A file or directory in the file system."""
+
+    def __init__(self, name, path, st, parent):
+        self.name = name
+        self.path = path
+        self.mtime = st.st_mtime
+        self.readonly = not st.st_mode & stat.S_IWUSR
+        self.parent = parent
+        self.children = []
+        self.is_dir = stat.S_ISDIR(st.st_mode)
+        self.size = 0 if self.is_dir else st.st_size
+        self.cluster = 0
+        self.clusters = 0
+
+
+class FatImage(object):
+    """Layout of a FAT file system with the content of some directories.
+
+    The entries listed in names get copied from directory source into
+    the root directory of a file system of size_mb MiB, like
+    "mcopy -s <source>/<name> ::/" does. Symlinks are followed.
+    """
+
+    def __init__(self, source, names, size_mb, fat_bits=None):
+        self.total_sectors = size_mb * 1024 * 1024 // SECTOR_SIZE
+        st = os.stat(source)
+        self.root = Node('', source, st, None)
+        for name in names:
+            self.add(self.root, to_unicode(name), os.path.join(source, name))
+        self.compute_layout(fat_bits)
+
+    def add(self, parent, name, path):
+        """Add path with all its content below parent."""
+        st = os.stat(path)
+        if not stat.S_ISDIR(st.st_mode) and not stat.S_ISREG(st.st_mode):
+            return
+        node = Node(name, path, st, parent)
+        parent.children.append(node)
+        if node.is_dir:
+            for child in sorted(os.listdir(path)):
+                self.add(node, to_unicode(child), os.path.join(path, child))
+
+    def compute_layout(self, fat_bits):
+        """Choose FAT type and cluster size, then allocate all clusters."""
+        # Cluster sizes as recommended by Microsoft for 512 byte sectors.
+        size_mb = self.total_sectors * SECTOR_SIZE // 1024 // 1024
+        if fat_bits is None:
+            fat_bits = 16 if size_mb <= 512 else 32
+        if fat_bits == 16:
+            sectors_per_cluster = 2
+            for limit_mb, spc in ((16, 2), (128, 4), (256, 8), (512, 16),
+                                  (1024, 32), (2048, 64)):
+                if size_mb <= limit_mb:
+                    sectors_per_cluster = spc
+                    break
+            self.reserved_sectors = 1
+            self.root_entries = 512
+        elif fat_bits == 32:
+            sectors_per_cluster = 64
+            for limit_mb, spc in ((260, 1), (8192, 8), (16384, 16),
+                                  (32768, 32)):
+                if size_mb <= limit_mb:
+                    sectors_per_cluster = spc
+                    break
+            self.reserved_sectors = 32
+            self.root_entries = 0
+        else:
+            raise ValueError('unsupported FAT type FAT%s' % fat_bits)
+        self.fat_bits = fat_bits
+
+        # Small file systems need smaller clusters to have enough of them.
+        while True:
+            self.sectors_per_cluster = sectors_per_cluster
+            self.compute_fat_size()
+            if self.cluster_count >= (4085 if fat_bits == 16 else 65525):
+                break
+            if sectors_per_cluster == 1:
+                raise ValueError('%d MiB is too small for FAT%d' %
+                                 (size_mb, fat_bits))
+            sectors_per_cluster //= 2
+        if self.cluster_count > (65524 if fat_bits == 16 else 0x0ffffff4):
+            raise ValueError('%d MiB is too large for FAT%d' %
+                             (size_mb, fat_bits))
+
+        # Allocate clusters in the order in which they get written:
+        # directories before their content, breadth first.
+        self.fat = [0] * (self.cluster_count + 2)
+        self.fat[0] = (0xfff8 if fat_bits == 16 else 0x0ffffff8)
+        self.fat[1] = (0xffff if fat_bits == 16 else 0x0fffffff)
+        self.next_cluster = 2
+        self.nodes = []
+        self.build_dirs(self.root)
+        # The root directory has room for a volume label entry at the
+        # end, which gets added by write() when there is a label.
+        root_size = len(self.root.entries) + DIR_ENTRY_SIZE
+        if fat_bits == 16 and root_size > self.root_entries * DIR_ENTRY_SIZE:
+            raise ValueError('too many entries in the root directory')
+        pending = [self.root]
+        while pending:
+            node = pending.pop(0)
+            if node is self.root:
+                if fat_bits == 32:
+                    self.allocate(node, root_size)
+            else:
+                self.allocate(node, len(node.entries) if node.is_dir
+                              else node.size)
+            if node.is_dir:
+                pending.extend(node.children)
+        self.build_dirs(self.root)
+
+    def compute_fat_size(self):
+        """Compute FAT size and cluster count for the current cluster size."""
+        root_sectors = self.root_entries * DIR_ENTRY_SIZE // SECTOR_SIZE
+        entry_bytes = self.fat_bits // 8
+        self.fat_sectors = 1
+        while True:
+            data_sectors = self.total_sectors - self.reserved_sectors - \
+                2 * self.fat_sectors - root_sectors
+            self.cluster_count = data_sectors // self.sectors_per_cluster
+            needed = ((self.cluster_count + 2) * entry_bytes +
+                      SECTOR_SIZE - 1) // SECTOR_SIZE
+            if needed <= self.fat_sectors:
+                break
+            self.fat_sectors = needed
+        self.root_dir_sector = self.reserved_sectors + 2 * self.fat_sectors
+        self.data_sector = self.root_dir_sector + root_sectors
+
+    def allocate(self, node, size):
+        """Allocate contiguous clusters for size bytes of node."""
+        cluster_size = self.sectors_per_cluster * SECTOR_SIZE
+        count = (size + cluster_size - 1) // cluster_size
+        if node.is_dir:
+            count = max(count, 1)
+        if not count:
+            return
+        if self.next_cluster + count > self.cluster_count + 2:
+            raise ValueError('%s: file system is full' % node.path)
+        node.cluster = self.next_cluster
+        node.clusters = count
+        for cluster in range(node.cluster, node.cluster + count - 1):
+            self.fat[cluster] = cluster + 1
+        self.fat[node.cluster + count - 1] = \
+            0xffff if self.fat_bits == 16 else 0x0fffffff
+        self.next_cluster += count
+        self.nodes.append(node)
+
+    def build_dirs(self, node):
+        """Generate the content of node and all directories below it.
+
+        Gets called twice, first to know the size of each directory,
+        then again after clusters are allocated.
+        """
+        entries = []
+        if node is not self.root:
+            # ".." refers to the root directory with cluster 0, also
+            # in FAT32.
+            parent_cluster = node.parent.cluster \
+                if node.parent is not self.root else 0
+            entries.append(dir_entry(b'.          ', ATTR_DIRECTORY,
+                                     node.cluster, 0, node.mtime))
+            entries.append(dir_entry(b'..         ', ATTR_DIRECTORY,
+                                     parent_cluster, 0, node.mtime))
+        used = set()
+        for child in node.children:
+            short_name, long_name = short_names(child.name, used)
+            if long_name:
+                entries.extend(long_name_entries(child.name, short_name))
+            attr = ATTR_DIRECTORY if child.is_dir else ATTR_ARCHIVE
+            if child.readonly:
+                attr |= ATTR_READ_ONLY
+            entries.append(dir_entry(short_name, attr, child.cluster,
+                                     child.size, child.mtime))
+            if child.is_dir:
+                self.build_dirs(child)
+        node.entries = b''.join(entries)
+
+    def boot_sector(self, volume_id, label, hidden_sectors):
+        """Pack the boot sector."""
+        total16 = self.total_sectors if self.total_sectors < 0x10000 else 0
+        common = struct.pack('<3s8sHBHBHHBHHHII',
+                             b'\xeb\x3c\x90' if self.fat_bits == 16
+                             else b'\xeb\x58\x90',
+                             b'MSWIN4.1', SECTOR_SIZE,
+                             self.sectors_per_cluster, self.reserved_sectors,
+                             2, self.root_entries, total16, 0xf8,
+                             self.fat_sectors if self.fat_bits == 16 else 0,
+                             32, 64, hidden_sectors,
+                             self.total_sectors if not total16 else 0)
+        extended = struct.pack('<BBBI11s8s', 0x80, 0, 0x29, volume_id,
+                               label or b'NO NAME    ',
+                               b'FAT16   ' if self.fat_bits == 16
+                               else b'FAT32   ')
+        if self.fat_bits == 32:
+            extended = struct.pack('<IHHIHH12s', self.fat_sectors, 0, 0,
+                                   2, 1, BACKUP_BOOT_SECTOR, b'') + extended
+        sector = common + extended
+        return sector + b'\0' * (SECTOR_SIZE - 2 - len(sector)) + b'\x55\xaa'
+
+    def fs_info(self):
+        """Pack the FAT32 FSInfo sector."""
+        return struct.pack('<I480sIII12sI', 0x41615252, b'', 0x61417272,
+                           self.cluster_count + 2 - self.next_cluster,
+                           self.next_cluster, b'', 0xaa550000)
+
+    def used_fat(self):
+        """Pack the used part of the FAT, the rest is zero."""
+        used = self.fat[:self.next_cluster]
+        return struct.pack('<%d%s' % (len(used), 'H' if self.fat_bits == 16
+                                      else 'I'), *used)
+
+    def digest(self, hasher):
+        """Return a digest of the file system content.
+
+        Covers everything that write() stores except for volume ID,
+        label and offset: the layout, directory entries with names,
+        sizes, attributes and time stamps in FAT resolution, and the
+        content of files as hashed by hasher (a treehash.TreeHash).
+        """
+        digest = hashlib.sha256()
+        digest.update(self.boot_sector(0, None, 0))
+        digest.update(self.used_fat())
+        digest.update(self.root.entries)
+        files = []
+        for node in self.nodes:
+            if node.is_dir:
+                digest.update(node.entries)
+            else:
+                path = os.path.abspath(node.path)
+                files.append((path, os.stat(path)))
+        for content in hasher.file_digests(files):
+            digest.update(content.encode('ascii'))
+        return digest.hexdigest()
+
+    def write(self, dst, offset=0, volume_id=None, label=None):
+        """Write the file system into file dst at offset (in bytes).
+
+        The area must contain zeros, as in a new sparse file, because
+        only used parts get written. By default the volume ID is random
+        and there is no volume label, like with mkdosfs.
+        """
+        if volume_id is None:
+            volume_id = uuid4().int & 0xffffffff
+        root_entries = self.root.entries
+        if label:
+            label = label.upper().encode('ascii')[:11].ljust(11)
+            root_entries += dir_entry(label, ATTR_VOLUME_ID, 0, 0,
+                                      self.root.mtime)
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            def write_at(sector, data):
+                os.lseek(fd, offset + sector * SECTOR_SIZE, os.SEEK_SET)
+                while data:
+                    written = os.write(fd, data)
+                    data = data[written:]
+
+            boot = self.boot_sector(volume_id, label,
+                                    offset // SECTOR_SIZE)
+            write_at(0, boot)
+            if self.fat_bits == 32:
+                write_at(1, self.fs_info())
+                write_at(BACKUP_BOOT_SECTOR, boot)
+                write_at(BACKUP_BOOT_SECTOR + 1, self.fs_info())
+            fat = self.used_fat()
+            for copy in range(2):
+                write_at(self.reserved_sectors + copy * self.fat_sectors, fat)
+            if self.fat_bits == 16:
+                write_at(self.root_dir_sector, root_entries)
+            for node in self.nodes:
+                sector = self.data_sector + \
+                    (node.cluster - 2) * self.sectors_per_cluster
+                if node.is_dir:
+                    write_at(sector, root_entries if node is self.root
+                             else node.entries)
+                    continue
+                os.lseek(fd, offset + sector * SECTOR_SIZE, os.SEEK_SET)
+                with open(node.path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        while chunk:
+                            written = os.write(fd, chunk)
+                            chunk = chunk[written:]
+        finally:
+            os.close(fd)
+
+
+def patch_boot_sector(fname, offset, volume_id, hidden_sectors=None):
+    """Change volume ID and hidden sectors of a FAT file system at offset.
+
+    This turns a copy of a file system into one which can be used next
+    to the original one.
+    """
+    fd = os.open(fname, os.O_RDWR)
+    try:
+        os.lseek(fd, offset, os.SEEK_SET)
+        boot = os.read(fd, SECTOR_SIZE)
+        # Only FAT32 has no FAT size in the common part of the BPB.
+        fat_bits = 32 if struct.unpack('<H', boot[22:24])[0] == 0 else 16
+        sectors = [0, BACKUP_BOOT_SECTOR] if fat_bits == 32 else [0]
+        for sector in sectors:
+            start = offset + sector * SECTOR_SIZE
+            os.lseek(fd, start + VOLUME_ID_OFFSET[fat_bits], os.SEEK_SET)
+            os.write(fd, struct.pack('<I', volume_id))
+            if hidden_sectors is not None:
+                os.lseek(fd, start + HIDDEN_SECTORS_OFFSET, os.SEEK_SET)
+                os.write(fd, struct.pack('<I', hidden_sectors))
+    finally:
+        os.close(fd)
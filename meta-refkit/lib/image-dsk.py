@@ -5,15 +5,23 @@
 # Copyright (C) 2015-2016 Intel Corporation
 # Licensed under the MIT license
 
+import ctypes
+import ctypes.util
+import errno
+import hashlib
 import json
 import os
 import sys
 import shutil
+from multiprocessing import Pool
 from re import sub
 from glob import glob
 from uuid import uuid4
-from subprocess import check_call
+from subprocess import check_call, CalledProcessError, Popen, PIPE, STDOUT
+from tempfile import TemporaryFile
 from bmaptools import Filemap
+from fatimage import FatImage, patch_boot_sector
+from treehash import TreeHash
 
 VARS = dict([x.split('=', 1) for x in sys.argv[1:]])
 
@@ -36,20 +44,147 @@ def symlink(src, dst):
     os.symlink(src, dst)
 
 
-def populate_rawcopy(src, dst):
+# All populate_* functions either create the file system in a dedicated
+# partition file <dst> (offset_mib = None) or inside the disk image <dst>,
+# at offset_mib with size_mb.
+
+def populate_rawcopy(src, dst, offset_mib=None, size_mb=None):
     """Argument src is a raw partition generated elsewhere."""
-    shutil.copyfile(src, dst)
+    if offset_mib is None:
+        shutil.copyfile(src, dst)
+    else:
+        sparse_copy(src, dst, offset_mib)
+
+
+# FatImage layouts by (source, size), because the UEFI partitions
+# usually share both.
+FAT_IMAGES = {}
+
+# Directories of the source which end up in FAT partitions.
+FAT_DIRECTORIES = ['EFI']
+
+
+def fat_image(src, size_mb):
+    """Return the FatImage for the EFI directory of <src>."""
+    if (src, size_mb) not in FAT_IMAGES:
+        FAT_IMAGES[(src, size_mb)] = FatImage(src, FAT_DIRECTORIES, size_mb)
+    return FAT_IMAGES[(src, size_mb)]
 
 
-def populate_vfat(src, dst):
+def populate_vfat(src, dst, offset_mib=None, size_mb=None):
     """Create and populate a FAT partition, out of a root directory <src>."""
-    check_call(['mkdosfs', dst])
-    check_call(['mcopy', '-i', dst, '-s', src + '/EFI', '::/'])
+    fat_image(src, size_mb).write(dst, (offset_mib or 0) * 1024 * 1024)
 
 
-def populate_ext4(src, dst):
+def ext4_options(offset_mib=None, size_mb=None):
+    """Return the mkfs.ext4 options, without source and destination."""
+    if offset_mib is None:
+        return ['-F']
+    # Discarding is disabled because it is not guaranteed to
+    # honor the offset. The disk image is created from scratch,
+    # so the area is known to be zero and neither inode tables
+    # nor the journal need to be zeroed, which keeps them sparse.
+    return ['-F', '-E', 'offset=%d,nodiscard,lazy_itable_init=1,'
+                        'lazy_journal_init=1' % (offset_mib * 1024 * 1024)]
+
+
+def populate_ext4(src, dst, offset_mib=None, size_mb=None):
     """Create and populate an ext4 partition out of a root directory <src>."""
-    check_call(['mkfs.ext4', '-F', dst] + (['-d', src] if src else []))
+    check_call(['mkfs.ext4'] + ext4_options(offset_mib, size_mb) +
+               (['-d', src] if src else []) + [dst] +
+               (['%dk' % (size_mb * 1024)] if offset_mib is not None else []))
+
+
+# mkfs_id_* functions return what identifies the tool creating a
+# partition of that type and how it gets called, see mkfs_id().
+
+# Output of "mke2fs -V", determined once.
+MKE2FS_VERSION = []
+
+
+def mkfs_id_ext4(offset_mib, size_mb):
+    """The version of mke2fs and its options."""
+    if not MKE2FS_VERSION:
+        mke2fs = Popen(['mke2fs', '-V'], stdout=PIPE, stderr=STDOUT)
+        MKE2FS_VERSION.append(mke2fs.communicate()[0].decode('utf-8'))
+        if mke2fs.returncode:
+            raise CalledProcessError(mke2fs.returncode, 'mke2fs -V')
+    return [MKE2FS_VERSION[0], ext4_options(offset_mib, size_mb)]
+
+
+def mkfs_id_vfat(offset_mib, size_mb):
+    """The directories copied by fatimage.py, whose code gets hashed anyway."""
+    return ['fatimage', FAT_DIRECTORIES]
+
+
+def mkfs_id(filesystem, offset_mib, size_mb):
+    """Return what identifies the creation of a partition, if anything."""
+    if 'mkfs_id_' + filesystem in globals():
+        return globals()['mkfs_id_' + filesystem](offset_mib, size_mb)
+    return None
+
+
+# source_hash_* functions return a digest of what a partition of that
+# type gets populated with, ignoring everything in <src> which does not
+# end up in the partition. For other types, the whole tree counts.
+
+def source_hash_rawcopy(hasher, src, size_mb):
+    """Only the content of the raw partition matters."""
+    return hasher.file_hashes([src])[0]
+
+
+def source_hash_vfat(hasher, src, size_mb):
+    """Only <src>/EFI, with what FAT can store about it."""
+    return fat_image(src, size_mb).digest(hasher)
+
+
+def source_hash(hasher, filesystem, src, size_mb):
+    """Return a digest of the source of a partition."""
+    if 'source_hash_' + filesystem in globals():
+        return globals()['source_hash_' + filesystem](hasher, src, size_mb)
+    return hasher.tree_hash(src)
+
+
+# clone_* functions turn a copy of a partition of that type at offset_mib
+# inside the disk image into a partition which can be used next to the
+# original, see do_dsk_image(). Only types with such a function get
+# copied instead of populated.
+
+def clone_rawcopy(dst, offset_mib, in_place):
+    """Raw partitions are copies of the same source anyway."""
+    pass
+
+
+def clone_vfat(dst, offset_mib, in_place):
+    """Give the copy its own volume ID."""
+    patch_boot_sector(dst, offset_mib * 1024 * 1024,
+                      uuid4().int & 0xffffffff,
+                      offset_mib * 2048 if in_place else None)
+
+
+def populate_partition(args):
+    """Create and populate one partition.
+
+    Either in a temporary loop file (offset_mib = None) or directly
+    inside the disk image.
+    """
+    filesystem, source, dst, partition_size_mb, offset_mib = args
+    try:
+        if offset_mib is None:
+            truncate_mib(dst, partition_size_mb)
+        globals()['populate_' + filesystem](source, dst,
+                                            offset_mib, partition_size_mb)
+    except (CalledProcessError, ValueError) as ex:
+        # Python 2 cannot unpickle CalledProcessError, which matters when
+        # running in a worker process.
+        raise RuntimeError('%s: %s' % (dst, ex))
+    return dst
+
+
+def lookup_bool(varname):
+    """Interpret a variable as boolean, like bb.utils.to_boolean()."""
+    return expand_vars('${%s}' % varname).strip().lower() in \
+        ('1', 'y', 'yes', 't', 'true', 'on')
 
 
 def expand_vars(arg_string, location=None):
@@ -59,37 +194,365 @@ def expand_vars(arg_string, location=None):
 
 
 def truncate_mib(fname, fsize):
-    """Create sparse file with requested size (in MiB)."""
-    with open(fname, "a+b") as fobj:
+    """Create sparse file with requested size (in MiB).
+
+    An existing file gets emptied first. Populating only writes the used
+    parts, so stale data, for example from an aborted build, must not
+    remain in the unused ones.
+    """
+    with open(fname, "wb") as fobj:
         fobj.truncate(int(fsize) * 1024 * 1024)
 
 
-def sparse_copy(src_fname, dst_fname, offset_mib=0):
-    """Efficiently copy sparse file to or into another file."""
+def libc_copy_file_range():
+    """Wrap copy_file_range() from glibc >= 2.27 like os.copy_file_range()."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.copy_file_range
+    except (OSError, AttributeError):
+        return None
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                     ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                     ctypes.c_size_t, ctypes.c_uint]
+
+    def copy_file_range(src, dst, count, offset_src, offset_dst):
+        off_in = ctypes.c_int64(offset_src)
+        off_out = ctypes.c_int64(offset_dst)
+        copied = func(src, ctypes.byref(off_in), dst, ctypes.byref(off_out),
+                      count, 0)
+        if copied < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return copied
+    return copy_file_range
+
+
+# Copying inside the kernel avoids passing all data through user space
+# and allows file systems to share extents (reflink) where supported.
+# os.copy_file_range() needs Python >= 3.8, image-dsk.py also runs with
+# Python 2, so fall back to calling glibc directly.
+COPY_FILE_RANGE = getattr(os, 'copy_file_range', None) or \
+    libc_copy_file_range()
+
+# Errors which indicate that copy_file_range() cannot be used at all
+# for the files, as opposed to real I/O errors.
+COPY_FILE_RANGE_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                               errno.EOPNOTSUPP, errno.EBADF)
+
+
+def copy_range(src_fd, dst_fd, start, offset, length, sinks=()):
+    """Copy length bytes at start in src_fd to start + offset in dst_fd.
+
+    The copied data also gets passed to the update() method of all sinks
+    (hash objects, CompressedImage), which requires passing the data
+    through user space.
+    """
+    global COPY_FILE_RANGE
+    while length > 0 and COPY_FILE_RANGE and not sinks:
+        try:
+            copied = COPY_FILE_RANGE(src_fd, dst_fd, length,
+                                     start, start + offset)
+        except OSError as ex:
+            if ex.errno not in COPY_FILE_RANGE_UNSUPPORTED:
+                raise
+            COPY_FILE_RANGE = None
+            break
+        if not copied:
+            # End of source file.
+            return
+        start += copied
+        length -= copied
+
+    # Fallback: copy through a buffer, in 1 MiB chunks.
+    chunk_size = 1024 * 1024
+    os.lseek(src_fd, start, os.SEEK_SET)
+    os.lseek(dst_fd, start + offset, os.SEEK_SET)
+    while length > 0:
+        chunk = os.read(src_fd, min(chunk_size, length))
+        if not chunk:
+            break
+        for sink in sinks:
+            sink.update(chunk)
+        while chunk:
+            written = os.write(dst_fd, chunk)
+            chunk = chunk[written:]
+            length -= written
+    if length > 0:
+        # Beyond the end of the source file, the destination
+        # contains zeros.
+        for sink in sinks:
+            sink.update(b'\0' * length)
+
+
+def sparse_copy(src_fname, dst_fname, offset_mib=0, start_mib=0, size_mb=None,
+                bmap=None, stream=None):
+    """Efficiently copy sparse file to or into another file.
+
+    With size_mb, only that many MiB starting at start_mib in the source
+    get copied, to start_mib + offset_mib in the destination. With bmap,
+    the ranges written to the destination get added to that BlockMap,
+    with stream the data gets passed on to that CompressedImage.
+    """
     filemap = Filemap.filemap(src_fname)
+    dst_fd = os.open(dst_fname, os.O_WRONLY | os.O_CREAT, 0o644)
     try:
-        dst_file = open(dst_fname, 'r+b')
-    except IOError:
-        dst_file = open(dst_fname, 'wb')
+        src_fd = filemap._f_image.fileno()
+        first_block = start_mib * 1024 * 1024 // filemap.block_size
+        if size_mb is None:
+            blocks_cnt = filemap.blocks_cnt - first_block
+        else:
+            blocks_cnt = size_mb * 1024 * 1024 // filemap.block_size
+        for first, last in filemap.get_mapped_ranges(first_block, blocks_cnt):
+            start = first * filemap.block_size
+            end = (last + 1) * filemap.block_size
+            offset = offset_mib * 1024 * 1024
+            sinks = []
+            if bmap:
+                digest = hashlib.sha256()
+                sinks.append(digest)
+            if stream:
+                stream.seek(start + offset)
+                sinks.append(stream)
+            copy_range(src_fd, dst_fd, start, offset, end - start, sinks)
+            if bmap:
+                bmap.add(start + offset, end + offset, digest.hexdigest())
+    finally:
+        os.close(dst_fd)
+
+
+def read_image(fname, start_mib, size_mb, bmap=None, stream=None):
+    """Pass the mapped ranges of a file in the given area to bmap and stream.
+
+    This is for those parts of the image which were not written by
+    sparse_copy(), because the data has to be read again.
+    """
+    filemap = Filemap.filemap(fname)
+    area_start = start_mib * 1024 * 1024
+    area_end = area_start + size_mb * 1024 * 1024
+    fd = filemap._f_image.fileno()
+    for first, last in filemap.get_mapped_ranges(
+            area_start // filemap.block_size,
+            (area_end - area_start) // filemap.block_size):
+        start = max(first * filemap.block_size, area_start)
+        end = min((last + 1) * filemap.block_size, area_end)
+        sinks = []
+        if bmap:
+            digest = hashlib.sha256()
+            sinks.append(digest)
+        if stream:
+            stream.seek(start)
+            sinks.append(stream)
+        os.lseek(fd, start, os.SEEK_SET)
+        length = end - start
+        while length > 0:
+            chunk = os.read(fd, min(1024 * 1024, length)) or \
+                b'\0' * min(1024 * 1024, length)
+            for sink in sinks:
+                sink.update(chunk)
+            length -= len(chunk)
+        if bmap:
+            bmap.add(start, end, digest.hexdigest())
+
+
+class CompressedImage(object):
+    """Compresses an image while it gets written, in a single pass.
+
+    Data must be passed in with increasing offsets. Small holes are
+    passed to the compressor as zeros. Large holes are not: both xz
+    and zstd decompress concatenated streams resp. frames into the
+    concatenation of their content, so the compressor gets restarted
+    after a hole and the hole is stored as copies of a precompressed
+    block of zeros.
+    """
+
+    COMMANDS = {
+        'xz': (['xz', '-T0', '-c'], '.xz'),
+        'zstd': (['zstd', '-T0', '-q', '-c'], '.zst'),
+    }
+
+    # Size of the precompressed block of zeros.
+    HOLE_BLOCK_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, compression, fname):
+        self.command, suffix = self.COMMANDS[compression]
+        self.fname = fname + suffix
+        self.pos = 0
+        self.process = None
+        self.hole_block = None
+        self.output = open(self.fname, 'wb')
+
+    def seek(self, offset):
+        """Continue at offset, which must not be before the current one."""
+        if offset < self.pos:
+            raise RuntimeError('%s: writing at %d after %d' %
+                               (self.fname, offset, self.pos))
+        blocks = (offset - self.pos) // self.HOLE_BLOCK_SIZE
+        if blocks:
+            self.finish()
+            if self.hole_block is None:
+                self.hole_block = self.compress_zeros(self.HOLE_BLOCK_SIZE)
+            for block in range(blocks):
+                self.output.write(self.hole_block)
+            self.output.flush()
+            self.pos += blocks * self.HOLE_BLOCK_SIZE
+        zeros = b'\0' * (1024 * 1024)
+        while self.pos < offset:
+            self.update(zeros[:offset - self.pos])
+
+    def compress_zeros(self, size):
+        """Return size zero bytes in compressed form."""
+        zeros = b'\0' * (1024 * 1024)
+        with TemporaryFile() as output:
+            process = Popen(self.command, stdin=PIPE, stdout=output)
+            for chunk in range(size // len(zeros)):
+                process.stdin.write(zeros)
+            process.stdin.close()
+            if process.wait():
+                raise CalledProcessError(process.returncode, self.command)
+            output.seek(0)
+            return output.read()
+
+    def update(self, data):
+        """Append data at the current offset."""
+        if not self.process:
+            # Shares the file offset with self.output.
+            self.process = Popen(self.command, stdin=PIPE, stdout=self.output)
+        self.process.stdin.write(data)
+        self.pos += len(data)
+
+    def finish(self):
+        """Wait for the current compressor, if any."""
+        if self.process:
+            self.process.stdin.close()
+            if self.process.wait():
+                raise CalledProcessError(self.process.returncode, self.command)
+            self.process = None
+
+    def close(self, size):
+        """Complete the image with zeros up to size and wait for the compressor."""
+        self.seek(size)
+        self.finish()
+        self.output.close()
+
+    def kill(self):
+        """Abort compressing, if still running."""
+        if self.process and self.process.returncode is None:
+            self.process.kill()
+            self.process.wait()
+        self.output.close()
+
 
-    for first, last in filemap.get_mapped_ranges(0, filemap.blocks_cnt):
-        start = first * filemap.block_size
-        end = (last + 1) * filemap.block_size
+class BlockMap(object):
+    """Collects the mapped ranges of an image for a bmaptool .bmap file."""
 
-        filemap._f_image.seek(start, os.SEEK_SET)
-        dst_file.seek((offset_mib * 1024 * 1024) + start, os.SEEK_SET)
+    BLOCK_SIZE = 4096
 
-        chunk_size = 1024 * 1024
-        to_read = end - start
-        read = 0
+    def __init__(self):
+        self.ranges = []
 
-        while read < to_read:
-            if read + chunk_size > to_read:
-                chunk_size = to_read - read
-            chunk = filemap._f_image.read(chunk_size)
-            dst_file.write(chunk)
-            read += chunk_size
-    dst_file.close()
+    def add(self, start, end, checksum):
+        """Add the range [start, end) in bytes with its sha256 checksum."""
+        self.ranges.append((start // self.BLOCK_SIZE,
+                            (end - 1) // self.BLOCK_SIZE, checksum))
+
+    def write(self, image_fname, bmap_fname):
+        """Write the block map in the format 2.0 of bmaptool."""
+        image_size = os.stat(image_fname).st_size
+        blocks_cnt = (image_size + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE
+        ranges = sorted(self.ranges)
+        mapped_cnt = sum([last - first + 1 for first, last, checksum
+                          in ranges])
+        lines = ['<?xml version="1.0" ?>',
+                 '<!-- This file contains the block map for an image file,'
+                 ' i.e. the blocks which',
+                 '     contain data and have to be copied to the target'
+                 ' device. -->',
+                 '',
+                 '<bmap version="2.0">',
+                 '    <!-- Image size in bytes: %.1f MiB -->' %
+                 (image_size / 1024.0 / 1024),
+                 '    <ImageSize> %d </ImageSize>' % image_size,
+                 '',
+                 '    <!-- Size of a block in bytes -->',
+                 '    <BlockSize> %d </BlockSize>' % self.BLOCK_SIZE,
+                 '',
+                 '    <!-- Count of blocks in the image file -->',
+                 '    <BlocksCount> %d </BlocksCount>' % blocks_cnt,
+                 '',
+                 '    <!-- Count of mapped blocks: %.1f MiB or %.1f%% -->' %
+                 (mapped_cnt * self.BLOCK_SIZE / 1024.0 / 1024,
+                  100.0 * mapped_cnt / max(blocks_cnt, 1)),
+                 '    <MappedBlocksCount> %d </MappedBlocksCount>' %
+                 mapped_cnt,
+                 '',
+                 '    <!-- Type of checksum used in this file -->',
+                 '    <ChecksumType> sha256 </ChecksumType>',
+                 '',
+                 '    <!-- The checksum of this bmap file. When it is'
+                 ' calculated, the value of',
+                 '         the checksum has be zero (all ASCII "0"'
+                 ' symbols). -->',
+                 '    <BmapFileChecksum> %s </BmapFileChecksum>' % ('0' * 64),
+                 '',
+                 '    <!-- The block map which consists of elements which'
+                 ' may either be a',
+                 '         range of blocks or a single block. The \'chksum\''
+                 ' attribute',
+                 '         is the checksum of this blocks range. -->',
+                 '    <BlockMap>']
+        for first, last, checksum in ranges:
+            lines.append('        <Range chksum="%s"> %s </Range>' %
+                         (checksum, first if first == last
+                          else '%d-%d' % (first, last)))
+        lines += ['    </BlockMap>', '</bmap>', '']
+        content = '\n'.join(lines)
+        checksum = hashlib.sha256(content.encode('ascii')).hexdigest()
+        with open(bmap_fname, 'w') as f:
+            f.write(content.replace('0' * 64, checksum, 1))
+
+
+# Per-partition hashes of the image, see do_dsk_image().
+PARTITION_HASHES = '-partition-hashes.json'
+
+
+def load_partition_hashes():
+    """Return the previous image and the hashes of its partitions.
+
+    Only an image which has not been modified since it was created is
+    usable, otherwise no hashes are returned.
+    """
+    hashes_file = os.path.join(expand_vars('${DEPLOY_DIR_IMAGE}'),
+                               expand_vars('${IMAGE_LINK_NAME}') +
+                               PARTITION_HASHES)
+    try:
+        with open(hashes_file) as f:
+            previous = json.load(f)
+        image_name = os.path.join(expand_vars('${DEPLOY_DIR_IMAGE}'),
+                                  previous['image'])
+        st = os.stat(image_name)
+    except (IOError, OSError, ValueError, KeyError):
+        return None, {}
+    if [st.st_size, st.st_mtime] != [previous.get('size'),
+                                     previous.get('mtime')]:
+        return None, {}
+    return image_name, previous.get('partitions', {})
+
+
+def save_partition_hashes(full_image_name, hashes):
+    """Store hashes next to the disk layout, for the next image."""
+    st = os.stat(full_image_name)
+    hashes_file = os.path.join(expand_vars('${IMGDEPLOYDIR}'),
+                               expand_vars('${IMAGE_NAME}') + PARTITION_HASHES)
+    with open(hashes_file, 'w') as f:
+        json.dump(obj={'image': os.path.basename(full_image_name),
+                       'size': st.st_size,
+                       'mtime': st.st_mtime,
+                       'partitions': hashes},
+                  fp=f, indent=4, separators=(',', ': '), sort_keys=True)
+    symlink(expand_vars('${IMAGE_NAME}') + PARTITION_HASHES,
+            os.path.join(expand_vars('${IMGDEPLOYDIR}'),
+                         expand_vars('${IMAGE_LINK_NAME}') + PARTITION_HASHES))
 
 
 def do_dsk_image():
@@ -140,39 +603,192 @@ def do_dsk_image():
     full_image_name = \
         os.path.join(expand_vars("${IMGDEPLOYDIR}"),
                      expand_vars('${IMAGE_NAME}.dsk'))
+    # Start from scratch, the image must not contain data from
+    # a previous run.
+    if os.path.exists(full_image_name):
+        os.remove(full_image_name)
     truncate_mib(full_image_name, full_image_size_mb)
-    check_call(['sgdisk', '-o', full_image_name])
 
+    # The whole GPT gets written by a single sgdisk call, instead of
+    # rewriting it once per partition. It gets written before populating
+    # partitions, so that it is complete when the image gets compressed
+    # while writing it.
+    sgdisk = ['sgdisk', '-o']
+    partitions = []
     partition_start_mb = partition_table["gpt_initial_offset_mb"]
     for key in sorted(partition_table.iterkeys()):
         if not isinstance(partition_table[key], dict):
             continue
         # Generate even more auxiliary variable
-        partition_logical_name = str(partition_table[key]["name"])
-        partition_size_mb = partition_table[key]["size_mb"]
         partition_name = expand_vars("${IMAGE_NAME}") + '.' + \
             partition_table[key]["name"] + ".part"
-        partition_type = expand_vars(partition_table[key]["type"])
         full_partition_name = \
             os.path.join(expand_vars("${IMGDEPLOYDIR}"), partition_name)
-        # Create the temporary loop file for hostong the partition.
-        truncate_mib(full_partition_name, partition_size_mb)
-        # Populate the partition accordingly to its parameters.
-        eval('populate_' + str(partition_table[key]["filesystem"]) +
-             '("' + expand_vars(partition_table[key]["source"]) + '", "' +
-             full_partition_name + '")')
+        partitions.append((key, partition_start_mb, full_partition_name))
         # Allocate space for the partition in the image loop file.
-        check_call(['sgdisk', '-c=0:' + partition_logical_name,
-                    '-n=0:' + str(partition_start_mb) + 'M:+' +
-                              str(partition_size_mb) + 'M',
-                    '-t=0:' + partition_type,
-                    '-u=0:' + str(partition_table[key]["uuid"]),
-                    full_image_name])
-        sparse_copy(full_partition_name, full_image_name, partition_start_mb)
-        # Remove the partition, now that it exists in the disk image.
-        if os.path.exists(full_partition_name):
-            os.remove(full_partition_name)
+        partition_number = str(len(partitions))
+        sgdisk += ['-n=%s:%dM:+%dM' % (partition_number, partition_start_mb,
+                                       partition_table[key]["size_mb"]),
+                   '-c=%s:%s' % (partition_number,
+                                 partition_table[key]["name"]),
+                   '-t=%s:%s' % (partition_number,
+                                 expand_vars(partition_table[key]["type"])),
+                   '-u=%s:%s' % (partition_number,
+                                 partition_table[key]["uuid"])]
         partition_start_mb += partition_table[key]["size_mb"]
+    check_call(sgdisk + [full_image_name])
+
+    # With DSK_IMAGE_IN_PLACE, the file systems get created directly at
+    # the right offset inside the disk image. This avoids writing the
+    # data twice and the temporary space for the partition files.
+    in_place = lookup_bool('DSK_IMAGE_IN_PLACE')
+
+    # With DSK_IMAGE_REUSE, partitions get copied from the previous
+    # image instead of creating them again when their source and where
+    # and how they get created is the same. The code creating
+    # partitions and the version and options of mkfs are covered, too.
+    reuse = lookup_bool('DSK_IMAGE_REUSE')
+    reused = set()
+    if reuse:
+        hasher = TreeHash(expand_vars('${DSK_IMAGE_TREEHASH_CACHE}'))
+        code = hasher.file_hashes([os.path.join(os.path.dirname(__file__), name)
+                                   for name in ('image-dsk.py', 'fatimage.py')])
+        hashes = {}
+        for key, partition_start_mb, full_partition_name in partitions:
+            filesystem = str(partition_table[key]["filesystem"])
+            hashes[key] = hashlib.sha256(json.dumps([
+                code,
+                filesystem,
+                partition_table[key]["size_mb"],
+                partition_start_mb,
+                in_place,
+                mkfs_id(filesystem, partition_start_mb if in_place else None,
+                        partition_table[key]["size_mb"]),
+                source_hash(hasher, filesystem,
+                            expand_vars(partition_table[key]["source"]),
+                            partition_table[key]["size_mb"])
+            ]).encode('utf-8')).hexdigest()
+        hasher.save()
+        previous_image_name, previous_hashes = load_partition_hashes()
+        reused = set([key for key in hashes
+                      if previous_hashes.get(key) == hashes[key]])
+
+    # Partitions with the same source, file system and size get
+    # populated only once. The others get copied from the first one
+    # inside the image, with per-partition metadata like the volume
+    # ID changed. clones maps them to the start of the first one.
+    clones = {}
+    first_partitions = {}
+    for key, partition_start_mb, full_partition_name in partitions:
+        filesystem = str(partition_table[key]["filesystem"])
+        if key in reused or 'clone_' + filesystem not in globals():
+            continue
+        identity = (expand_vars(partition_table[key]["source"]), filesystem,
+                    partition_table[key]["size_mb"])
+        if identity in first_partitions:
+            clones[key] = first_partitions[identity]
+        else:
+            first_partitions[identity] = partition_start_mb
+
+    # Populating partitions is independent of each other, so with
+    # DSK_IMAGE_POPULATE_JOBS > 1 it is done in parallel. Results are
+    # processed in order, as soon as each partition is ready.
+    populate_args = [(str(partition_table[key]["filesystem"]),
+                      expand_vars(partition_table[key]["source"]),
+                      full_image_name if in_place else full_partition_name,
+                      partition_table[key]["size_mb"],
+                      partition_start_mb if in_place else None)
+                     for key, partition_start_mb, full_partition_name
+                     in partitions if key not in reused and key not in clones]
+    jobs = min(int(expand_vars('${DSK_IMAGE_POPULATE_JOBS}') or 1),
+               len(populate_args))
+    pool = None
+    if jobs > 1:
+        pool = Pool(jobs)
+        populated = pool.imap(populate_partition, populate_args)
+    else:
+        populated = (populate_partition(x) for x in populate_args)
+
+    # With DSK_IMAGE_BMAP, the block map gets collected while copying
+    # partitions into the image. Only what was written some other way
+    # has to be read again.
+    bmap = BlockMap() if lookup_bool('DSK_IMAGE_BMAP') else None
+
+    # With DSK_IMAGE_COMPRESSION, a compressed copy of the image gets
+    # written at the same time, because everything gets written in
+    # order of increasing offsets.
+    compression = expand_vars('${DSK_IMAGE_COMPRESSION}').strip()
+    if compression and compression not in CompressedImage.COMMANDS:
+        exit("image-dsk.py: DSK_IMAGE_COMPRESSION must be one of %s, not %s." %
+             (', '.join(sorted(CompressedImage.COMMANDS)), compression))
+    stream = CompressedImage(compression, full_image_name) \
+        if compression else None
+
+    try:
+        # The GPT at the beginning of the image.
+        if bmap or stream:
+            read_image(full_image_name, 0,
+                       partition_table["gpt_initial_offset_mb"], bmap, stream)
+        for key, partition_start_mb, full_partition_name in partitions:
+            if key not in reused and key not in clones:
+                next(populated)
+            partition_size_mb = partition_table[key]["size_mb"]
+            if key in clones:
+                sparse_copy(full_image_name, full_image_name,
+                            partition_start_mb - clones[key],
+                            start_mib=clones[key], size_mb=partition_size_mb)
+                globals()['clone_' + str(partition_table[key]["filesystem"])](
+                    full_image_name, partition_start_mb, in_place)
+                if bmap or stream:
+                    read_image(full_image_name, partition_start_mb,
+                               partition_size_mb, bmap, stream)
+                continue
+            if key in reused:
+                sparse_copy(previous_image_name, full_image_name,
+                            start_mib=partition_start_mb,
+                            size_mb=partition_size_mb,
+                            bmap=bmap, stream=stream)
+                continue
+            if in_place:
+                if bmap or stream:
+                    read_image(full_image_name, partition_start_mb,
+                               partition_size_mb, bmap, stream)
+                continue
+            sparse_copy(full_partition_name, full_image_name, partition_start_mb,
+                        bmap=bmap, stream=stream)
+            # Remove the partition, now that it exists in the disk image.
+            if os.path.exists(full_partition_name):
+                os.remove(full_partition_name)
+        # The backup GPT at the end.
+        if bmap or stream:
+            read_image(full_image_name,
+                       full_image_size_mb - partition_table["gpt_tail_padding_mb"],
+                       partition_table["gpt_tail_padding_mb"], bmap, stream)
+        if stream:
+            stream.close(full_image_size_mb * 1024 * 1024)
+    finally:
+        # All partitions are done at this point unless there was an
+        # error, in which case the remaining ones are not needed anymore.
+        if pool:
+            pool.terminate()
+            pool.join()
+        if stream:
+            stream.kill()
+
+    if reuse:
+        save_partition_hashes(full_image_name, hashes)
+
+    if stream:
+        symlink(os.path.basename(stream.fname),
+                os.path.join(expand_vars("${IMGDEPLOYDIR}"),
+                             expand_vars('${IMAGE_LINK_NAME}.dsk') +
+                             stream.fname[len(full_image_name):]))
+    if bmap:
+        bmap.write(full_image_name, full_image_name + '.bmap')
+        symlink(expand_vars('${IMAGE_NAME}.dsk.bmap'),
+                os.path.join(expand_vars("${IMGDEPLOYDIR}"),
+                             expand_vars('${IMAGE_LINK_NAME}.dsk.bmap')))
+
 
 if __name__ == "__main__":
     do_dsk_image()
@@ -0,0 +1,135 @@
+import errno
+import hashlib
+import json
+import os
+import tempfile
+
+from oeqa.selftest.base import oeSelfTest
+from oeqa.utils.commands import bitbake, get_bb_var
+
+import fatimage
+import treehash
+
+class ImageDskTests(oeSelfTest):
+
+    image = 'refkit-image-minimal'
+
+    def read_partitions(self):
+        """
+        Return the sha256 of each UEFI partition and the UUID of the ext4
+        rootfs, which mkfs.ext4 picks randomly, in the current .dsk image.
+        """
+        layout = json.loads(get_bb_var('DSK_IMAGE_LAYOUT', self.image))
+        deploy_dir = get_bb_var('DEPLOY_DIR_IMAGE', self.image)
+        link_name = get_bb_var('IMAGE_LINK_NAME', self.image)
+        uefi = {}
+        rootfs = None
+        offset = layout['gpt_initial_offset_mb'] * 1024 * 1024
+        with open(os.path.join(deploy_dir, link_name + '.dsk'), 'rb') as dsk:
+            for key in sorted(layout.keys()):
+                partition = layout[key]
+                if not isinstance(partition, dict):
+                    continue
+                size = partition['size_mb'] * 1024 * 1024
+                if partition['filesystem'] == 'vfat':
+                    dsk.seek(offset)
+                    uefi[key] = hashlib.sha256(dsk.read(size)).hexdigest()
+                elif partition['name'] == 'rootfs':
+                    # s_uuid in the superblock.
+                    dsk.seek(offset + 1024 + 0x68)
+                    rootfs = dsk.read(16)
+                offset += size
+        self.assertTrue(uefi, msg='no UEFI partitions in DSK_IMAGE_LAYOUT')
+        self.assertIsNotNone(rootfs, msg='no rootfs partition in DSK_IMAGE_LAYOUT')
+        return uefi, rootfs
+
+    def test_dsk_reuse_partitions(self):
+        """
+        With DSK_IMAGE_REUSE, building the image again after do_uefiapp
+        and do_rootfs ran again with unchanged kernel and initramfs must
+        copy the UEFI partitions from the previous image, while a
+        modified rootfs must get created again.
+        """
+        if get_bb_var('REFKIT_USE_DSK_IMAGES', self.image) != 'True':
+            self.skipTest('MACHINE does not use image-dsk.bbclass')
+        self.write_config('DSK_IMAGE_REUSE = "1"')
+
+        bitbake(self.image)
+        first_uefi, first_rootfs = self.read_partitions()
+        # Creates the applications and their directories in
+        # ${DEPLOYDIR} and the rootfs with /boot again.
+        bitbake('-C uefiapp ' + self.image)
+        second_uefi, second_rootfs = self.read_partitions()
+        self.assertEqual(first_uefi, second_uefi,
+                         msg='UEFI partitions were created again instead of being reused')
+        self.assertNotEqual(first_rootfs, second_rootfs,
+                            msg='modified rootfs partition was reused')
+
+        # Only a file in the rootfs changes.
+        rootfs = get_bb_var('IMAGE_ROOTFS', self.image)
+        if not os.path.isdir(rootfs):
+            self.skipTest('%s was removed after the build' % rootfs)
+        with open(os.path.join(rootfs, 'etc', 'dsk-reuse-test'), 'w') as f:
+            f.write('modified')
+        bitbake('-C image_dsk ' + self.image)
+        third_uefi, third_rootfs = self.read_partitions()
+        self.assertEqual(second_uefi, third_uefi,
+                         msg='UEFI partitions were created again instead of being reused')
+        self.assertNotEqual(second_rootfs, third_rootfs,
+                            msg='modified rootfs partition was reused')
+
+    def test_fat_short_names_case(self):
+        """
+        Names which only differ in case must not get the same 8.3 short
+        name, regardless of the order in which they get added.
+        """
+        for names in (['BOOT.EFI', 'BOOT.efi', 'boot.efi', 'Boot.Efi'],
+                      ['boot.efi', 'BOOT.efi', 'BOOT.EFI']):
+            used = set()
+            shorts = [fatimage.short_names(name, used) for name in names]
+            self.assertEqual(len(set([short for short, long_name in shorts])), len(names),
+                             msg='duplicate short names for %s: %s' % (names, shorts))
+            for name, (short, long_name) in zip(names, shorts):
+                # Names which are not stored as they are need a long name.
+                if short != b'BOOT    EFI' or name != 'BOOT.EFI':
+                    self.assertTrue(long_name, msg='%s stored as %s without long name' % (name, short))
+
+    def make_tree(self):
+        tree = tempfile.mkdtemp(prefix='treehash-')
+        self.track_for_cleanup(tree)
+        for name in ('a', 'b'):
+            with open(os.path.join(tree, name), 'w') as f:
+                f.write('same content')
+        return tree
+
+    def tree_hash(self, tree):
+        # Only what is in the tree may matter, not the time stamps
+        # changed by creating it.
+        for name in ('a', 'b', '.'):
+            os.utime(os.path.join(tree, name), (0, 0))
+        return treehash.TreeHash().tree_hash(tree)
+
+    def test_treehash_xattr(self):
+        """
+        Changing only an extended attribute (as used for Smack labels
+        and IMA/EVM signatures) must change the tree hash.
+        """
+        tree = self.make_tree()
+        before = self.tree_hash(tree)
+        try:
+            os.setxattr(os.path.join(tree, 'a'), 'user.test', b'1')
+        except OSError as ex:
+            if ex.errno == errno.ENOTSUP:
+                self.skipTest('%s does not support extended attributes' % tree)
+            raise
+        self.assertNotEqual(before, self.tree_hash(tree))
+
+    def test_treehash_hardlink(self):
+        """
+        Turning a copy into a hardlink must change the tree hash.
+        """
+        tree = self.make_tree()
+        before = self.tree_hash(tree)
+        os.remove(os.path.join(tree, 'b'))
+        os.link(os.path.join(tree, 'a'), os.path.join(tree, 'b'))
+        self.assertNotEqual(before, self.tree_hash(tree))
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# Adds sections to PE/COFF images like
+#   objcopy --add-section <name>=<file> --change-section-vma <name>=<vma>
+# does, without running a process per EFI application.
+#
+# The stub gets patched in memory, the content of the new sections gets
+# streamed into the output in a single pass while computing the PE
+# checksum.
+#
+# Copyright (C) 2017 Intel Corporation
+# Licensed under the MIT license
+
+import os
+import struct
+import sys
+from array import array
+
+# Initialized, read-only data. The same as objcopy uses for
+# sections added with --add-section.
+SECTION_CHARACTERISTICS = 0x40000040
+
+SECTION_HEADER_SIZE = 40
+DIRECTORY_CERTIFICATE = 4
+DIRECTORY_DEBUG = 6
+DEBUG_DIRECTORY_SIZE = 28
+
+
+def align(value, alignment):
+    """Round value up to a multiple of alignment."""
+    return (value + alignment - 1) // alignment * alignment
+
+
+class Checksum(object):
+    """Computes the PE image checksum of the data passed to update()."""
+
+    def __init__(self):
+        self.total = 0
+        self.length = 0
+        self.odd = b''
+
+    def update(self, data):
+        data = self.odd + bytes(data)
+        self.length += len(data) - len(self.odd)
+        self.odd = data[len(data) & ~1:]
+        words = array('H', data[:len(data) & ~1])
+        if sys.byteorder == 'big':
+            words.byteswap()
+        self.total += sum(words)
+
+    def value(self):
+        total = self.total + (struct.unpack('<H', self.odd + b'\0')[0]
+                              if self.odd else 0)
+        while total >> 16:
+            total = (total & 0xffff) + (total >> 16)
+        return (total + self.length) & 0xffffffff
+
+
+class Image(object):
+    """The headers and sections of a PE/COFF image (the EFI stub)."""
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        if self.data[:2] != b'MZ':
+            raise ValueError('not a PE/COFF image: no MZ header')
+        self.pe = self.unpack('<I', 0x3c)
+        if self.data[self.pe:self.pe + 4] != b'PE\0\0':
+            raise ValueError('not a PE/COFF image: no PE signature')
+        self.coff = self.pe + 4
+        self.opt = self.coff + 20
+        magic = self.unpack('<H', self.opt)
+        if magic == 0x10b:
+            self.image_base = self.unpack('<I', self.opt + 28)
+            self.directories = self.opt + 96
+        elif magic == 0x20b:
+            self.image_base = self.unpack('<Q', self.opt + 24)
+            self.directories = self.opt + 112
+        else:
+            raise ValueError('not a PE/COFF image: optional header magic %#x' %
+                             magic)
+        self.section_table = self.opt + self.unpack('<H', self.coff + 16)
+
+    def unpack(self, fmt, offset):
+        return struct.unpack_from(fmt, bytes(self.data[offset:offset + 8]))[0]
+
+    def pack(self, fmt, offset, value):
+        self.data[offset:offset + struct.calcsize(fmt)] = \
+            struct.pack(fmt, value)
+
+    # Fields which are the same in PE32 and PE32+.
+    number_of_sections = property(
+        lambda self: self.unpack('<H', self.coff + 2),
+        lambda self, value: self.pack('<H', self.coff + 2, value))
+    symbol_table = property(
+        lambda self: self.unpack('<I', self.coff + 8),
+        lambda self, value: self.pack('<I', self.coff + 8, value))
+    initialized_data_size = property(
+        lambda self: self.unpack('<I', self.opt + 8),
+        lambda self, value: self.pack('<I', self.opt + 8, value))
+    section_alignment = property(
+        lambda self: self.unpack('<I', self.opt + 32))
+    file_alignment = property(
+        lambda self: self.unpack('<I', self.opt + 36))
+    image_size = property(
+        lambda self: self.unpack('<I', self.opt + 56),
+        lambda self, value: self.pack('<I', self.opt + 56, value))
+    headers_size = property(
+        lambda self: self.unpack('<I', self.opt + 60),
+        lambda self, value: self.pack('<I', self.opt + 60, value))
+    checksum_offset = property(lambda self: self.opt + 64)
+
+    def directory(self, index):
+        """Return (address, size) of a data directory entry."""
+        offset = self.directories + index * 8
+        if offset + 8 > self.section_table:
+            return 0, 0
+        return struct.unpack('<II', bytes(self.data[offset:offset + 8]))
+
+    def sections(self):
+        """Return the offsets of all section headers."""
+        return [self.section_table + i * SECTION_HEADER_SIZE
+                for i in range(self.number_of_sections)]
+
+    def rva_to_offset(self, rva):
+        """Return the file offset of an address, None if not in a section."""
+        for header in self.sections():
+            virtual_size, address, raw_size, raw_pointer = \
+                struct.unpack('<IIII', bytes(self.data[header + 8:header + 24]))
+            if address <= rva < address + max(virtual_size, raw_size):
+                return raw_pointer + rva - address
+        return None
+
+    def grow_headers(self, needed):
+        """Make room for headers of size needed by moving all sections."""
+        delta = align(needed - self.headers_size, self.file_alignment)
+        first_address = min([self.unpack('<I', header + 12)
+                             for header in self.sections()] or [0])
+        if first_address and self.headers_size + delta > first_address:
+            raise ValueError('no room for more section headers')
+        if self.directory(DIRECTORY_CERTIFICATE)[1]:
+            raise ValueError('cannot add sections to a signed image')
+        # File offsets which need to be moved: section data, symbols
+        # and the data of debug directory entries.
+        debug_address, debug_size = self.directory(DIRECTORY_DEBUG)
+        debug = self.rva_to_offset(debug_address) if debug_size else None
+        for header in self.sections():
+            if self.unpack('<I', header + 20):
+                self.pack('<I', header + 20,
+                          self.unpack('<I', header + 20) + delta)
+        if self.symbol_table:
+            self.symbol_table += delta
+        if debug is not None:
+            for entry in range(debug, debug + debug_size,
+                               DEBUG_DIRECTORY_SIZE):
+                if self.unpack('<I', entry + 24):
+                    self.pack('<I', entry + 24,
+                              self.unpack('<I', entry + 24) + delta)
+        self.data[self.headers_size:self.headers_size] = bytearray(delta)
+        self.headers_size += delta
+
+
+def add_sections(stub, sections, output):
+    """Write a copy of PE/COFF image stub with additional sections.
+
+    sections is a list of (name, file, vma) tuples, where vma is the
+    absolute address of the section like with objcopy, i.e. including
+    the image base. Instead of a single file, the content of a section
+    can also be given as a list of files which get concatenated.
+    """
+    sections = [(name, files if isinstance(files, (list, tuple)) else [files], vma)
+                for name, files, vma in sections]
+    with open(stub, 'rb') as f:
+        image = Image(f.read())
+    needed = image.section_table + \
+        (image.number_of_sections + len(sections)) * SECTION_HEADER_SIZE
+    if needed > image.headers_size:
+        image.grow_headers(needed)
+
+    # New sections go after everything which is in the stub.
+    file_alignment = image.file_alignment
+    section_alignment = image.section_alignment
+    raw_pointer = align(len(image.data), file_alignment)
+    headers = []
+    for name, fnames, vma in sections:
+        if len(name) > 8:
+            raise ValueError('%s: section names are limited to 8 characters' %
+                             name)
+        size = sum([os.stat(fname).st_size for fname in fnames])
+        raw_size = align(size, file_alignment)
+        address = vma - image.image_base
+        if address < image.headers_size:
+            raise ValueError('%s: vma %#x is below the image base and headers' %
+                             (name, vma))
+        headers.append(struct.pack('<8sIIIIIIHHI', name.encode('ascii'),
+                                   size, address, raw_size, raw_pointer,
+                                   0, 0, 0, 0, SECTION_CHARACTERISTICS))
+        image.initialized_data_size += raw_size
+        image.image_size = max(image.image_size,
+                               align(address + size, section_alignment))
+        raw_pointer += raw_size
+    offset = image.section_table + \
+        image.number_of_sections * SECTION_HEADER_SIZE
+    image.data[offset:offset + len(sections) * SECTION_HEADER_SIZE] = \
+        b''.join(headers)
+    image.number_of_sections += len(sections)
+    image.pack('<I', image.checksum_offset, 0)
+    image.data += bytearray(align(len(image.data), file_alignment) -
+                            len(image.data))
+
+    checksum = Checksum()
+    with open(output, 'wb') as out:
+        def write(data):
+            checksum.update(data)
+            out.write(data)
+
+        write(image.data)
+        for name, fnames, vma in sections:
+            size = 0
+            for fname in fnames:
+                with open(fname, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        write(chunk)
+                        size += len(chunk)
+            write(bytearray(align(size, file_alignment) - size))
+        out.seek(image.checksum_offset)
+        out.write(struct.pack('<I', checksum.value()))
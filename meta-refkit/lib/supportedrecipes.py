@@ -2,6 +2,10 @@
 # supported-recipes.bbclass.
 
 import csv
+import glob
+import hashlib
+import heapq
+import json
 import os
 import re
 try:
@@ -10,6 +14,9 @@ except ImportError:
     import urllib.parse as urlparse
 import pkgutil
 import inspect
+import multiprocessing.util
+import sqlite3
+import tempfile
 
 import bb
 import supportedrecipesreport
@@ -25,12 +32,26 @@ class Columns(object):
     To add new classes, create a "lib/supportedrecipesreport" directory in your layer,
     with an empty "__init__.py" file and one or more classes inheriting from this base
     class defined in one or more regular .py files.
+
+    Alternatively, layers can list their classes explicitly in layer.conf, as in:
+    SUPPORTED_RECIPES_SOURCES_COLUMNS += "supportedrecipesreport.foo:FooColumns"
+    Then only the listed classes are used and no modules get scanned.
+
+    Classes which do not need to see all rows in advance should set
+    needs_all_rows = False. When all classes do that, rows are streamed
+    through extend_row() and sorted afterwards without keeping all of
+    them in memory.
     """
+
+    # All rows get passed to __init__() unless a derived class sets
+    # this to False, in which case all_rows is empty.
+    needs_all_rows = True
+
     def __init__(self, d, all_rows):
         """Initialize instance.
 
         Gets access to the global datastore and all rows that are to be written (unmodified
-        and read-only).
+        and read-only) if needs_all_rows is set.
         """
         pass
 
@@ -83,12 +104,195 @@ class SupportedRecipe:
                          (collection is None or self.collection_re[0].match(collection)))
         return self.supportedby if supported else ''
 
+# Characters which turn the side of an entry into a regular expression.
+# Entries without them are plain names and get looked up in a dict.
+REGEX_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+# Entries which cannot be merged into a larger alternation without
+# changing their meaning: anchors, backreferences, named groups,
+# inline flags, lookaheads and lookbehinds (a lookahead in the recipe
+# part would see the "@<collection>" suffix). Those get matched
+# individually, same as entries with a top-level alternation.
+NOT_COMBINABLE_RE = re.compile(r'\\[1-9AZ]|\(\?[aiLmsux<P=!]|[\^$]')
+
+def has_toplevel_alternation(regex):
+    # The trailing '$' added by parse_regex() only binds to the last
+    # branch of a top-level alternation ("a|b" matches "abc"). Such
+    # entries must not be wrapped in a group.
+    depth = 0
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == '\\':
+            i += 1
+        elif c == '[':
+            # Skip character class, including a leading ] or ^].
+            i += 1
+            if i < len(regex) and regex[i] == '^':
+                i += 1
+            if i < len(regex) and regex[i] == ']':
+                i += 1
+            while i < len(regex) and regex[i] != ']':
+                if regex[i] == '\\':
+                    i += 1
+                i += 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+def is_combinable(regex):
+    return not NOT_COMBINABLE_RE.search(regex) and \
+        not has_toplevel_alternation(regex)
+
+class SupportedRecipesMatcher:
+    """Compiled form of all entries in a SupportedRecipes instance.
+
+    Literal <recipe>@<collection> entries are stored in a dict, all other
+    entries are merged into one alternation per team which gets matched
+    against "<recipe>@<collection>". That turns a lookup into one
+    dict access plus one regex match per team.
+
+    The same is done for the recipe side alone, with one alternation per
+    collection, for determining in which collections a recipe would
+    be supported.
+    """
+    def __init__(self, supported):
+        self.literals = {}
+        self.fallback = []
+        self.pn_literals = {}
+        self.pn_fallback = []
+        alternatives = {}
+        pn_alternatives = {}
+        for recipe in supported:
+            pn_regex = recipe.pn_re[1]
+            collection_regex = recipe.collection_re[1]
+            if not REGEX_CHARS.intersection(pn_regex + collection_regex):
+                self.literals.setdefault((pn_regex, collection_regex), set()).add(recipe.supportedby)
+            elif not is_combinable(pn_regex) or not is_combinable(collection_regex):
+                self.fallback.append(recipe)
+            else:
+                alternatives.setdefault(recipe.supportedby, []).append(
+                    '(?:%s)@(?:%s)' % (pn_regex, collection_regex))
+            if not REGEX_CHARS.intersection(pn_regex):
+                self.pn_literals.setdefault(pn_regex, set()).add(collection_regex)
+            elif not is_combinable(pn_regex):
+                self.pn_fallback.append(recipe)
+            else:
+                pn_alternatives.setdefault(collection_regex, []).append('(?:%s)' % pn_regex)
+        self.patterns = [(re.compile('(?:%s)$' % '|'.join(alternatives[supportedby])), supportedby)
+                         for supportedby in sorted(alternatives)]
+        self.pn_patterns = [(re.compile('(?:%s)$' % '|'.join(pn_alternatives[collection_regex])),
+                             collection_regex)
+                            for collection_regex in sorted(pn_alternatives)]
+
+    def supportedby(self, pn, collection):
+        result = set(self.literals.get((pn, collection), ()))
+        entry = pn + '@' + collection
+        for pattern, supportedby in self.patterns:
+            if supportedby not in result and pattern.match(entry):
+                result.add(supportedby)
+        for recipe in self.fallback:
+            supportedby = recipe.is_supportedby(pn, collection)
+            if supportedby:
+                result.add(supportedby)
+        return result
+
+    def collections(self, pn):
+        # Regular expressions for all collections in which the recipe
+        # is supported.
+        result = set(self.pn_literals.get(pn, ()))
+        for pattern, collection_regex in self.pn_patterns:
+            if collection_regex not in result and pattern.match(pn):
+                result.add(collection_regex)
+        for recipe in self.pn_fallback:
+            if recipe.is_supportedby(pn, None):
+                result.add(recipe.collection_re[1])
+        return result
+
+# Number of verdict files kept in SUPPORTED_RECIPES_VERDICTS_DIR. More than
+# one because multiconfig builds or configurations switching between
+# different SUPPORTED_RECIPES share the directory.
+VERDICTS_KEEP = 10
+
 class SupportedRecipes:
     def __init__(self):
         self.supported = []
+        self.matcher = None
+        # Hash of the content of all SUPPORTED_RECIPES files, set by
+        # load_supported_recipes(). Identifies the verdicts file.
+        self.digest = None
+        self.verdicts_dir = None
+        self.verdicts = None
+        self.verdicts_modified = False
 
     def append(self, recipe):
         self.supported.append(recipe)
+        self.matcher = None
+        self.verdicts = None
+
+    def verdicts_file(self):
+        if self.verdicts_dir and self.digest:
+            return os.path.join(self.verdicts_dir, self.digest + '.json')
+        return None
+
+    def load_verdicts(self):
+        # Verdicts from previous bitbake invocations are only valid
+        # for exactly the same SUPPORTED_RECIPES content, which is
+        # guaranteed by the digest in the file name.
+        self.verdicts = {}
+        self.verdicts_modified = False
+        filename = self.verdicts_file()
+        if filename:
+            try:
+                with open(filename) as f:
+                    self.verdicts = json.load(f)
+                # Marks the file as recently used for save_verdicts().
+                os.utime(filename, None)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def save_verdicts(self):
+        # Only called by check_build(), i.e. by a single process. Parse workers
+        # merely read the file, so the atomic rename is sufficient to avoid
+        # reading incomplete content.
+        filename = self.verdicts_file()
+        if not filename or not self.verdicts_modified:
+            return
+        bb.utils.mkdirhier(self.verdicts_dir)
+        tmpfile = '%s.%d' % (filename, os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump(self.verdicts, f)
+        os.rename(tmpfile, filename)
+        self.verdicts_modified = False
+        # Verdicts for content which has not been used for a while are
+        # probably obsolete.
+        files = []
+        for other in glob.glob(os.path.join(self.verdicts_dir, '*.json')):
+            try:
+                files.append((os.stat(other).st_mtime, other))
+            except OSError:
+                pass
+        for mtime, obsolete in sorted(files, reverse=True)[VERDICTS_KEEP:]:
+            if obsolete != filename:
+                try:
+                    os.remove(obsolete)
+                except OSError:
+                    pass
+
+    def get_matcher(self):
+        if not self.matcher:
+            self.matcher = SupportedRecipesMatcher(self.supported)
+        return self.matcher
+
+    def hint_collections(self, pn):
+        # Returns sorted list of collections in which the recipe
+        # would be supported.
+        return sorted(self.get_matcher().collections(pn))
 
     def current_recipe_supportedby(self, d):
         pn = d.getVar('PN', True)
@@ -99,6 +303,20 @@ class SupportedRecipes:
     def recipe_supportedby(self, pn, collection):
         # Returns list of of teams supporting the recipe (could be
         # more than one or none).
+        if pn is not None and collection is not None and \
+           '@' not in pn and '@' not in collection:
+            # The common case, handled by the persistent verdicts
+            # and the compiled matcher. Names containing the separator
+            # would be ambiguous in the combined regular expressions.
+            if self.verdicts is None:
+                self.load_verdicts()
+            entry = pn + '@' + collection
+            verdict = self.verdicts.get(entry, None)
+            if verdict is None:
+                verdict = sorted(self.get_matcher().supportedby(pn, collection))
+                self.verdicts[entry] = verdict
+                self.verdicts_modified = True
+            return list(verdict)
         result = set()
         for recipe in self.supported:
             supportedby = recipe.is_supportedby(pn, collection)
@@ -107,22 +325,48 @@ class SupportedRecipes:
         return sorted(result)
 
 
+# Process-level cache for load_supported_recipes(), keyed by the
+# list of files plus their team names, mtimes and sizes and by
+# the directory with the persistent verdicts. The anonymous
+# python in supported-recipes.bbclass calls load_supported_recipes()
+# for every single recipe, so without this cache each parse worker
+# would re-read and re-compile all entries thousands of times.
+_supported_recipes_cache = {}
+
 def load_supported_recipes(d):
 
-    files = []
     supported_files = d.getVar('SUPPORTED_RECIPES', True)
     if not supported_files:
         bb.fatal('SUPPORTED_RECIPES is not set')
-    supported_recipes = SupportedRecipes()
+
+    key = []
     for filename in supported_files.split():
+        base = os.path.basename(filename)
+        supportedby = d.getVarFlag('SUPPORTED_RECIPES', base, True)
+        if not supportedby:
+            supportedby = base.rstrip('.txt')
+        try:
+            st = os.stat(filename)
+        except OSError as ex:
+            bb.fatal('Could not read SUPPORTED_RECIPES = %s: %s' % (supported_files, str(ex)))
+        key.append((filename, supportedby, st.st_mtime, st.st_size))
+    verdicts_dir = d.getVar('SUPPORTED_RECIPES_VERDICTS_DIR', True)
+    key = (verdicts_dir, tuple(key))
+
+    cached = _supported_recipes_cache.get(key, None)
+    if cached:
+        return cached
+
+    files = []
+    supported_recipes = SupportedRecipes()
+    digest = hashlib.sha256()
+    for filename, supportedby, mtime, size in key[1]:
         try:
-            base = os.path.basename(filename)
-            supportedby = d.getVarFlag('SUPPORTED_RECIPES', base, True)
-            if not supportedby:
-                supportedby = base.rstrip('.txt')
             with open(filename) as f:
+                digest.update(('%s\n' % supportedby).encode('utf-8'))
                 linenumber = 1
                 for line in f:
+                    digest.update(line.encode('utf-8'))
                     if line.startswith('#'):
                         continue
                     # TODO (?): sanity check the content to catch
@@ -137,15 +381,111 @@ def load_supported_recipes(d):
             files.append(filename)
         except OSError as ex:
             bb.fatal('Could not read SUPPORTED_RECIPES = %s: %s' % (supported_files, str(ex)))
+    supported_recipes.digest = digest.hexdigest()
+    supported_recipes.verdicts_dir = verdicts_dir
 
+    # Only the most recent content is of interest, older entries
+    # would just waste memory.
+    _supported_recipes_cache.clear()
+    _supported_recipes_cache[key] = (supported_recipes, files)
     return (supported_recipes, files)
 
 SOURCE_FIELDS = 'component,collection,version,homepage,source,summary,license'.split(',')
 
+# All information about recipe sources is stored in a single sqlite
+# database inside SUPPORTED_RECIPES_SOURCES_DIR, keyed by recipe name and
+# file name. Compared to one small file per recipe this avoids thousands
+# of file creates and opens, which matters on network file systems.
+# sqlite serializes the parallel parse threads which write into it.
+SOURCES_DB = 'sources.db'
+
+# Parse threads may have to wait for each other, so be patient.
+SOURCES_DB_TIMEOUT = 300
+
+_sources_db = None
+
+def open_sources_db(dirname):
+    # Keeps the connection open for all recipes parsed by the current
+    # process. A connection inherited via fork() must not be used.
+    global _sources_db
+    path = os.path.join(dirname, SOURCES_DB)
+    if _sources_db and _sources_db[:2] == (path, os.getpid()):
+        return _sources_db[2]
+    bb.utils.mkdirhier(dirname)
+    db = sqlite3.connect(path, timeout=SOURCES_DB_TIMEOUT)
+    with db:
+        db.execute('CREATE TABLE IF NOT EXISTS sources '
+                   '(pn TEXT, file TEXT, idx INTEGER, %s, PRIMARY KEY (pn, file, idx))' %
+                   ', '.join(['%s TEXT' % field for field in SOURCE_FIELDS]))
+    _sources_db = (path, os.getpid(), db)
+    return db
+
+# dump_sources() buffers rows and writes them in bulk, in one transaction
+# per SOURCES_DB_BATCH recipes and when the parse process exits.
+SOURCES_DB_BATCH = 100
+
+# (database directory, pid, list of (pn, filename, rows)) of the current process.
+_pending_sources = None
+
+def flush_sources():
+    # Writes all rows buffered by dump_sources() in the current process.
+    global _pending_sources
+    if not _pending_sources or _pending_sources[1] != os.getpid():
+        return
+    dirname, pid, pending = _pending_sources
+    _pending_sources = (dirname, pid, [])
+    if not pending:
+        return
+    db = open_sources_db(dirname)
+    with db:
+        db.executemany('DELETE FROM sources WHERE pn = ? AND file = ?',
+                       [(pn, filename) for pn, filename, rows in pending])
+        db.executemany('INSERT INTO sources VALUES (?, ?, ?, %s)' %
+                       ', '.join(['?'] * len(SOURCE_FIELDS)),
+                       [row for pn, filename, rows in pending for row in rows])
+
+def read_sources(dirname):
+    # Returns all rows in a single scan, as (pn, file, row) tuples
+    # where row contains SOURCE_FIELDS.
+    flush_sources()
+    db = open_sources_db(dirname)
+    for row in db.execute('SELECT pn, file, %s FROM sources ORDER BY pn, file, idx' %
+                          ', '.join(SOURCE_FIELDS)):
+        yield row[0], row[1], row[2:]
+
+# Decoded SRC_URI entries. The variants of a recipe (native, nativesdk, ...)
+# get parsed by the same process and share most of their SRC_URI entries.
+_decoded_sources = {}
+
+def decode_sources(src):
+    # Turns a list of SRC_URI entries into a list of (name, url) tuples
+    # for all non-local sources, with url stripped of all parameters.
+    sources = []
+    for url in src:
+        decoded = _decoded_sources.get(url, None)
+        if decoded is None:
+            scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+            if scheme != 'file':
+                parts = path.split(';')
+                if len(parts) > 1:
+                    path = parts[0]
+                    params = dict([x.split('=') if '=' in x else (x, '') for x in parts[1:]])
+                else:
+                    params = {}
+                name = params.get('name', None)
+                decoded = (name, '%s://%s%s' % (scheme, netloc, path))
+            else:
+                decoded = ()
+            _decoded_sources[url] = decoded
+        if decoded:
+            sources.append(decoded)
+    return sources
+
 # Collects information about one recipe during parsing for SUPPORTED_RECIPES_SOURCES.
 # The dumped information cannot be removed because it might be needed in future
 # bitbake invocations, so the default location is inside the tmp directory.
 def dump_sources(d):
+    global _pending_sources
     pn = d.getVar('PN', True)
     filename = d.getVar('FILE', True)
     collection = bb.utils.get_file_layer(filename, d)
@@ -154,60 +494,84 @@ def dump_sources(d):
     homepage = d.getVar('HOMEPAGE', True) or ''
     src = d.getVar('SRC_URI', True).split()
     license = d.getVar('LICENSE', True)
-    sources = []
-    for url in src:
-        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
-        if scheme != 'file':
-            parts = path.split(';')
-            if len(parts) > 1:
-                path = parts[0]
-                params = dict([x.split('=') if '=' in x else (x, '') for x in parts[1:]])
-            else:
-                params = {}
-            name = params.get('name', None)
-            sources.append((name, '%s://%s%s' % (scheme, netloc, path)))
-    dumpfile = d.getVar('SUPPORTED_RECIPES_SOURCES_DIR', True) + '/' + pn + filename
-    bb.utils.mkdirhier(os.path.dirname(dumpfile))
-    with open(dumpfile, 'w') as f:
-        # File intentionally kept small by not writing a header
-        # line. Guaranteed to contain SOURCE_FIELDS.
-        writer = csv.writer(f)
-        for idx, val in enumerate(sources):
-            name, url = val
-            if name and len(sources) != 1:
-                fullname = '%s/%s' % (pn, name)
-            elif idx > 0:
-                fullname = '%s/%d' % (pn, idx)
-            else:
-                fullname = pn
-            writer.writerow((fullname, collection, pv, homepage, url, summary, license))
+    sources = decode_sources(src)
+    rows = []
+    for idx, val in enumerate(sources):
+        name, url = val
+        if name and len(sources) != 1:
+            fullname = '%s/%s' % (pn, name)
+        elif idx > 0:
+            fullname = '%s/%d' % (pn, idx)
+        else:
+            fullname = pn
+        rows.append((pn, filename, idx, fullname, collection, pv, homepage, url, summary, license))
+
+    dirname = d.getVar('SUPPORTED_RECIPES_SOURCES_DIR', True)
+    if _pending_sources and _pending_sources[:2] != (dirname, os.getpid()):
+        flush_sources()
+        _pending_sources = None
+    if not _pending_sources:
+        _pending_sources = (dirname, os.getpid(), [])
+        # Parse workers are multiprocessing.Process instances, which run
+        # such finalizers when they exit (plain atexit handlers
+        # would not be called).
+        multiprocessing.util.Finalize(None, flush_sources, exitpriority=10)
+    _pending_sources[2].append((pn, filename, rows))
+    if len(_pending_sources[2]) >= SOURCES_DB_BATCH:
+        flush_sources()
 
 class IsNative(object):
     def __init__(self, d):
         # Always add a trailing $ to ensure a full match.
         native_recipes = d.getVar('SUPPORTED_RECIPES_NATIVE_RECIPES', True).split()
         self.isnative_exception = re.compile('(' + '|'.join(native_recipes) + ')$')
-        self.isnative_baseclasses = d.getVar('SUPPORTED_RECIPES_NATIVE_BASECLASSES', True).split()
-
-    def __call__(self, pn, pndata):
-        for inherited in pndata['inherits']:
-            if os.path.basename(inherited) in self.isnative_baseclasses:
-                return True
+        self.isnative_baseclasses = frozenset(d.getVar('SUPPORTED_RECIPES_NATIVE_BASECLASSES', True).split())
+        # The same few classes are inherited by all recipes, so
+        # remember the result for each full path of an inherited class.
+        self.isnative_inherited = {}
+        # Result of isnative_exception per recipe name.
+        self.isnative_pn = {}
+
+    def native_inherited(self, inherits):
+        # Returns the subset of the inherited classes which are native base classes.
+        native = set()
+        for inherited in inherits:
+            isnative = self.isnative_inherited.get(inherited, None)
+            if isnative is None:
+                isnative = os.path.basename(inherited) in self.isnative_baseclasses
+                self.isnative_inherited[inherited] = isnative
+            if isnative:
+                native.add(inherited)
+        return native
+
+    def native_exception(self, pn):
         # Some build recipes do not inherit cross.bbclass and must be skipped explicitly.
         # The "real" recipes (in cases like glibc) still get checked. Other recipes are OE-core
         # internal helpers.
-        if self.isnative_exception.match(pn):
-            return True
+        isnative = self.isnative_pn.get(pn, None)
+        if isnative is None:
+            isnative = bool(self.isnative_exception.match(pn))
+            self.isnative_pn[pn] = isnative
+        return isnative
 
-class TruncatedError(Exception):
-    pass
+    def __call__(self, pn, pndata):
+        return bool(self.native_inherited(pndata['inherits'])) or \
+            self.native_exception(pn)
 
-def dump_dependencies(depgraph, max_lines, unsupported):
-    # Walk the recipe dependency tree and add one line for each path that ends in
-    # an unsupported recipe.
-    lines = []
-    current_line = []
+    def classify(self, pns):
+        """Returns the set of native recipes in a depgraph['pn'] dict.
 
+        Each distinct inherited class gets checked only once for all recipes.
+        """
+        inherits = set()
+        for pndata in pns.values():
+            inherits.update(pndata['inherits'])
+        native = self.native_inherited(inherits)
+        return set([pn for pn, pndata in pns.items()
+                    if not native.isdisjoint(pndata['inherits']) or
+                    self.native_exception(pn)])
+
+def recipe_dependencies(depgraph):
     # Pre-compute complete dependencies (DEPEND and RDEPEND) for each recipe
     # instead of doing it each time we reach a recipe. Also identifies those
     # recipes that nothing depends on. They are the start points for the build.
@@ -223,71 +587,285 @@ def dump_dependencies(depgraph, max_lines, unsupported):
                 roots.discard(pndep)
     for pn in deps:
         deps[pn] = sorted(deps[pn])
-
-    # We can prune the search tree a lot by keeping track of those recipes which are already
-    # known to not depend on an unsupported recipe.
+    return deps, roots
+
+def reaches_unsupported(deps, unsupported):
+    # Determines all recipes from which an unsupported recipe can be
+    # reached, including the unsupported recipes themselves, by walking
+    # the reversed dependencies once. Cycles need no special
+    # treatment because each recipe gets added only once.
+    rdeps = {}
+    for pn, pndeps in deps.items():
+        for dep in pndeps:
+            rdeps.setdefault(dep, []).append(pn)
+    reaching = set(unsupported)
+    pending = list(reaching)
+    while pending:
+        for rdep in rdeps.get(pending.pop(), []):
+            if rdep not in reaching:
+                reaching.add(rdep)
+                pending.append(rdep)
+    return reaching
+
+def dependency_chains(deps, roots, unsupported):
+    # Walk the recipe dependency tree and yield one line for each path that ends in
+    # an unsupported recipe. The lines are produced lazily, so the caller
+    # can stop early.
+    #
+    # Recipes which cannot reach any unsupported recipe are skipped
+    # entirely. In addition we keep track of those recipes which did not
+    # lead to a line when visited, because the only paths to an
+    # unsupported recipe were cut short by a recursive dependency.
+    reaching = reaches_unsupported(deps, unsupported)
     okay = set()
 
-    def visit_recipe(pn):
-        if pn in okay:
-            return False
-        if pn in current_line:
-            # Recursive dependency, bail out. Can happen
-            # because we flattened the task dependencies; those don't have
-            # cycles.
-            return False
-        current_line.append(pn)
-        printed = False
-        for dep in deps.get(pn, []):
-            if visit_recipe(dep):
-                printed = True
-        if not printed and \
-           pn in unsupported and \
-           not len(current_line) == 1:
-            # Current path is non-trivial, ends in an unsupported recipe and was not alread
-            # included in a longer, printed path. Add a copy to the output.
-            if len(lines) >= max_lines:
-                raise TruncatedError()
-            lines.append(current_line[:])
-            printed = True
-        if not printed and not pn in unsupported:
-            okay.add(pn)
-        del current_line[-1]
-        return printed
-
-    truncated = False
-    try:
-        for pn in sorted(roots):
-            visit_recipe(pn)
-    except TruncatedError:
-        truncated = True
-    return lines, truncated
+    for root in sorted(roots):
+        if root not in reaching or root in okay:
+            continue
+        current_line = [root]
+        on_line = set(current_line)
+        # Each entry is [recipe, iterator over remaining dependencies, printed].
+        stack = [[root, iter(deps.get(root, [])), False]]
+        while stack:
+            entry = stack[-1]
+            for dep in entry[1]:
+                # A recipe already on the line is a recursive dependency,
+                # skip it. Can happen because we flattened the task
+                # dependencies; those don't have cycles.
+                if dep in reaching and dep not in okay and dep not in on_line:
+                    current_line.append(dep)
+                    on_line.add(dep)
+                    stack.append([dep, iter(deps.get(dep, [])), False])
+                    break
+            else:
+                # All dependencies visited.
+                pn, printed = entry[0], entry[2]
+                if not printed and \
+                   pn in unsupported and \
+                   not len(current_line) == 1:
+                    # Current path is non-trivial, ends in an unsupported recipe and was not alread
+                    # included in a longer, printed path.
+                    yield current_line[:]
+                    printed = True
+                if not printed and not pn in unsupported:
+                    okay.add(pn)
+                stack.pop()
+                current_line.pop()
+                on_line.discard(pn)
+                if printed and stack:
+                    stack[-1][2] = True
+
+def first_lines(chains, max_lines):
+    # Returns up to max_lines dependency chains, plus a flag whether
+    # there would have been more.
+    lines = []
+    for line in chains:
+        if len(lines) >= max_lines:
+            return lines, True
+        lines.append(line)
+    return lines, False
+
+def dump_dependencies(depgraph, max_lines, unsupported):
+    # Returns up to max_lines dependency chains which end in an unsupported
+    # recipe, plus a flag whether there would have been more.
+    deps, roots = recipe_dependencies(depgraph)
+    return first_lines(dependency_chains(deps, roots, unsupported), max_lines)
+
+def hint_collections(pn, supported_recipes):
+    # Determines the collections in which the recipe would be supported.
+    return supported_recipes.hint_collections(pn)
 
 def collection_hint(pn, supported_recipes):
     # Determines whether the recipe would be supported in some other collection.
-    collections = set([supported_recipe.collection_re[1]
-                       for supported_recipe
-                       in supported_recipes.supported
-                       if supported_recipe.is_supportedby(pn, None)])
+    collections = hint_collections(pn, supported_recipes)
     return ' (would be supported in %s)' % ' '.join(collections) if collections else ''
 
+def escape_name(name):
+    # Left and right side of the <recipe>@<collection> entries are
+    # regular expressions. In contrast to re.escape(), we only
+    # escape + (as in gtk+3). Escaping all non-alphanumerics
+    # makes many entries (like linux-yocto) unnecessarily less
+    # readable (linux\-yocto).
+    return name.replace('+', r'\+')
+
 def dump_unsupported(unsupported, supported_recipes):
     # Turns the mapping from unsupported recipe to is collection
     # into a sorted list of entries in the final report.
     lines = []
     for pn, collection in unsupported.items():
-        # Left and right side of the <recipe>@<collection> entries are
-        # regular expressions. In contrast to re.escape(), we only
-        # escape + (as in gtk+3). Escaping all non-alphanumerics
-        # makes many entries (like linux-yocto) unnecessarily less
-        # readable (linux\-yocto).
-        pn = pn.replace('+', r'\+')
-        collection = collection.replace('+', r'\+')
+        pn = escape_name(pn)
+        collection = escape_name(collection)
         hint = collection_hint(pn, supported_recipes)
         entry = '%s@%s%s' % (pn, collection, hint)
         lines.append(entry)
     return sorted(lines)
 
+def write_check_report(filename, files, unsupported, supported_recipes, dependencies, truncated):
+    # Writes the result of check_build() as JSON, for consumption by tools.
+    # Entries get written one at a time, into a temporary file which
+    # replaces the report once it is complete.
+    bb.utils.mkdirhier(os.path.dirname(os.path.abspath(filename)))
+    tmpfile = '%s.%d' % (filename, os.getpid())
+    with open(tmpfile, 'w') as f:
+        f.write('{\n  "supported_recipes": %s,\n  "unsupported": [' % json.dumps(files))
+        separator = '\n'
+        for pn, collection in sorted(unsupported.items()):
+            entry = '%s@%s' % (escape_name(pn), escape_name(collection))
+            f.write(separator)
+            f.write('    ' + json.dumps({
+                'recipe': pn,
+                'collection': collection,
+                'entry': entry,
+                'supported_in': hint_collections(escape_name(pn), supported_recipes),
+            }, sort_keys=True))
+            separator = ',\n'
+        f.write('\n  ],\n  "dependencies": [')
+        separator = '\n'
+        for line in dependencies:
+            f.write(separator)
+            f.write('    ' + json.dumps(line))
+            separator = ',\n'
+        f.write('\n  ],\n  "truncated": %s\n}\n' % json.dumps(truncated))
+    os.rename(tmpfile, filename)
+
+def source_rows(dirname, recipes):
+    # Produces the rows for the SUPPORTED_RECIPES_SOURCES report
+    # from the dumped sources of the given recipes, which
+    # map (pn, filename) to the teams supporting the recipe.
+    for pn, filename, row in read_sources(dirname):
+        supportedby = recipes.get((pn, filename), None)
+        if supportedby is None:
+            continue
+        row_hash = {f: row[i] for i, f in enumerate(SOURCE_FIELDS)}
+        row_hash['supported'] = 'yes (%s)' % ' '.join(supportedby) \
+                                if supportedby else 'no'
+        yield row_hash
+
+# Maximum number of rows sorted in memory by sort_rows(). Larger
+# reports get sorted in chunks of this size which then get merged.
+SORT_ROWS_IN_MEMORY = 10000
+
+def sort_rows(rows, fields, max_rows=SORT_ROWS_IN_MEMORY):
+    # Sort by first column, then second column, etc. Each row is turned
+    # into a list of strings, the same way as csv would write it.
+    # Sorted runs of max_rows rows each are stored in temporary files
+    # and get merged at the end, so memory usage is bounded.
+    runs = []
+    current = []
+    try:
+        for row in rows:
+            current.append([str(row.get(f, None) or '') for f in fields])
+            if len(current) >= max_rows:
+                run = tempfile.TemporaryFile(mode='w+', newline='')
+                csv.writer(run).writerows(sorted(current))
+                run.seek(0)
+                runs.append(run)
+                current = []
+        current.sort()
+        if not runs:
+            for row in current:
+                yield row
+            return
+        for row in heapq.merge(iter(current), *[csv.reader(run) for run in runs]):
+            yield row
+    finally:
+        for run in runs:
+            run.close()
+
+# Classes found by find_columns(), per value of SUPPORTED_RECIPES_SOURCES_COLUMNS.
+_columns_cache = {}
+
+def find_columns(d):
+    # All classes which extend the SUPPORTED_RECIPES_SOURCES report.
+    # Either listed explicitly as <module>:<class> in SUPPORTED_RECIPES_SOURCES_COLUMNS
+    # or found by importing all modules in the supportedrecipesreport package.
+    # Either way, this is done only once per process.
+    registered = d.getVar('SUPPORTED_RECIPES_SOURCES_COLUMNS', True) or ''
+    classes = _columns_cache.get(registered, None)
+    if classes is not None:
+        return classes
+
+    classes = []
+    if registered.split():
+        for entry in registered.split():
+            modname, _, clazzname = entry.partition(':')
+            try:
+                module = __import__(modname, fromlist="dummy")
+                clazz = getattr(module, clazzname)
+            except (ImportError, AttributeError) as ex:
+                bb.fatal('SUPPORTED_RECIPES_SOURCES_COLUMNS: loading %s failed: %s' % (entry, str(ex)))
+            if not inspect.isclass(clazz) or not issubclass(clazz, Columns):
+                bb.fatal('SUPPORTED_RECIPES_SOURCES_COLUMNS: %s is not derived from supportedrecipes.Columns' % entry)
+            classes.append(clazz)
+    else:
+        for importer, modname, ispkg in pkgutil.iter_modules(supportedrecipesreport.__path__):
+            module = __import__('supportedrecipesreport.' + modname, fromlist="dummy")
+            for name, clazz in inspect.getmembers(module, inspect.isclass):
+                if issubclass(clazz, Columns):
+                    classes.append(clazz)
+    _columns_cache[registered] = classes
+    return classes
+
+def write_sources_report(d, report_sources, rows):
+    classes = find_columns(d)
+    # The base class itself gets found when a module imports it.
+    if [clazz for clazz in classes if clazz.needs_all_rows and clazz is not Columns]:
+        # Fall back to keeping everything in memory.
+        rows = list(rows)
+        all_rows = rows
+    else:
+        all_rows = []
+    extensions = [clazz(d, all_rows) for clazz in classes]
+    fields = SOURCE_FIELDS[:]
+    # Insert after 'collection'.
+    fields.insert(fields.index('collection') + 1, 'supported')
+    for e in extensions:
+        e.extend_header(fields)
+
+    def extended_rows():
+        for row in rows:
+            for e in extensions:
+                e.extend_row(row)
+            yield row
+
+    with open(report_sources, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        # Sorting happens after extending all rows.
+        writer.writerows(sort_rows(extended_rows(), fields))
+
+def check_config(d, supported_recipes):
+    # Everything besides the depgraph which has an effect on the result
+    # of check_build().
+    config = [supported_recipes.digest]
+    for var in ('SUPPORTED_RECIPES_NATIVE_RECIPES',
+                'SUPPORTED_RECIPES_NATIVE_BASECLASSES',
+                'SUPPORTED_RECIPES_CHECK_DEPENDENCY_LINES',
+                'BBFILE_COLLECTIONS'):
+        config.append(d.getVar(var, True) or '')
+    for collection in (d.getVar('BBFILE_COLLECTIONS', True) or '').split():
+        config.append(d.getVar('BBFILE_PATTERN_' + collection, True) or '')
+    return config
+
+def load_check_state(filename, config):
+    # Returns the state saved by save_check_state() if it was produced
+    # with the same configuration, otherwise an empty state.
+    try:
+        with open(filename) as f:
+            state = json.load(f)
+        if state.get('config', None) == config:
+            return state
+    except (IOError, OSError, ValueError):
+        pass
+    return {}
+
+def save_check_state(filename, state):
+    bb.utils.mkdirhier(os.path.dirname(filename))
+    tmpfile = '%s.%d' % (filename, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmpfile, filename)
+
 def check_build(d, event):
     supported_recipes, files = load_supported_recipes(d)
     supported_recipes_check = d.getVar('SUPPORTED_RECIPES_CHECK', True)
@@ -310,56 +888,94 @@ def check_build(d, event):
     dirname = d.getVar('SUPPORTED_RECIPES_SOURCES_DIR', True)
     report_sources = d.getVar('SUPPORTED_RECIPES_SOURCES', True)
 
-    unsupported = {}
-    sources = []
+    # With SUPPORTED_RECIPES_CHECK_STATE, the result for each recipe and
+    # the dependency chains are stored. The next check then only needs to
+    # look at recipes which are new or have changed.
+    statefile = d.getVar('SUPPORTED_RECIPES_CHECK_STATE', True)
+    max_lines = int(d.getVar('SUPPORTED_RECIPES_CHECK_DEPENDENCY_LINES', True))
+    if statefile:
+        config = check_config(d, supported_recipes)
+        state = load_check_state(statefile, config)
+        deps, roots = recipe_dependencies(depgraph)
+    else:
+        state = {}
+        deps = None
+    previous = state.get('recipes', {})
+    current = {}
+    unchanged = set(previous.keys()) == set(depgraph['pn'].keys())
+
+    # Recipes which are new or have changed since the previous check.
+    changed = {}
     for pn, pndata in depgraph['pn'].items():
+        entry = previous.get(pn, None)
+        if deps is None or not entry or \
+           entry['filename'] != pndata['filename'] or \
+           entry['inherits'] != pndata['inherits'] or \
+           entry['deps'] != deps.get(pn, []):
+            changed[pn] = pndata
+        else:
+            current[pn] = entry
+    if changed:
+        unchanged = False
         # We only care about recipes compiled for the target.
         # Most native ones can be detected reliably because they inherit native.bbclass,
         # but some special cases have to be hard-coded.
         # Image recipes also do not matter.
-        if not isnative(pn, pndata):
-            filename = pndata['filename']
-            collection = bb.utils.get_file_layer(filename, d)
-            supportedby = supported_recipes.recipe_supportedby(pn, collection)
-            if not supportedby:
-                unsupported[pn] = collection
+        native = isnative.classify(changed)
+    for pn, pndata in changed.items():
+        entry = {
+            'filename': pndata['filename'],
+            'inherits': pndata['inherits'],
+            'deps': deps.get(pn, []) if deps is not None else [],
+            'native': pn in native,
+        }
+        if not entry['native']:
+            entry['collection'] = bb.utils.get_file_layer(entry['filename'], d)
+            entry['supportedby'] = supported_recipes.recipe_supportedby(pn, entry['collection'])
+        current[pn] = entry
+
+    unsupported = {}
+    recipes = {}
+    for pn, entry in current.items():
+        if not entry['native']:
+            if not entry['supportedby']:
+                unsupported[pn] = entry['collection']
             if report_sources:
-                dumpfile = os.path.join(dirname, pn + filename)
-                with open(dumpfile) as f:
-                    reader = csv.reader(f)
-                    for row in reader:
-                        row_hash = {f: row[i] for i, f in enumerate(SOURCE_FIELDS)}
-                        row_hash['supported'] = 'yes (%s)' % ' '.join(supportedby) \
-                                                if supportedby else 'no'
-                        sources.append(row_hash)
+                recipes[(pn, entry['filename'])] = entry['supportedby']
+
+    # Remember the verdicts for the next bitbake invocation and the
+    # parse workers, before the logger below might abort.
+    supported_recipes.save_verdicts()
+
+    if unsupported:
+        if unchanged and 'dependencies' in state:
+            # Same recipes and dependencies as last time, so also the
+            # same unsupported recipes and dependency chains.
+            dependencies, truncated = state['dependencies'], state['truncated']
+        else:
+            if deps is None:
+                deps, roots = recipe_dependencies(depgraph)
+            dependencies, truncated = first_lines(dependency_chains(deps, roots, unsupported), max_lines)
+    if statefile:
+        state = {'config': config, 'recipes': current}
+        if unsupported:
+            state['dependencies'] = dependencies
+            state['truncated'] = truncated
+        save_check_state(statefile, state)
+
+    report_check = d.getVar('SUPPORTED_RECIPES_CHECK_REPORT', True)
+    if report_check:
+        if not unsupported:
+            dependencies, truncated = [], False
+        write_check_report(report_check, files, unsupported, supported_recipes,
+                           dependencies, truncated)
+        bb.note('Created SUPPORTED_RECIPES_CHECK_REPORT = %s file.' % report_check)
 
     if report_sources:
-        with open(report_sources, 'w') as f:
-            fields = SOURCE_FIELDS[:]
-            # Insert after 'collection'.
-            fields.insert(fields.index('collection') + 1, 'supported')
-            extensions = []
-            for importer, modname, ispkg in pkgutil.iter_modules(supportedrecipesreport.__path__):
-                module = __import__('supportedrecipesreport.' + modname, fromlist="dummy")
-                for name, clazz in inspect.getmembers(module, inspect.isclass):
-                    if issubclass(clazz, Columns):
-                        extensions.append(clazz(d, sources))
-            for e in extensions:
-                e.extend_header(fields)
-            writer = csv.DictWriter(f, fields)
-            writer.writeheader()
-            for row in sources:
-                for e in extensions:
-                    e.extend_row(row)
-            # Sort by first column, then second column, etc., after extending all rows.
-            for row in sorted(sources, key=lambda r: [r.get(f, None) for f in fields]):
-                writer.writerow(row)
+        write_sources_report(d, report_sources, source_rows(dirname, recipes))
         bb.note('Created SUPPORTED_RECIPES_SOURCES = %s file.' % report_sources)
 
     if unsupported:
-        max_lines = int(d.getVar('SUPPORTED_RECIPES_CHECK_DEPENDENCY_LINES', True))
-        dependencies, truncated = dump_dependencies(depgraph, max_lines, unsupported)
-
         output = []
         output.append('The following unsupported recipes are required for the build:')
         output.extend(['  ' + line for line in dump_unsupported(unsupported, supported_recipes)])
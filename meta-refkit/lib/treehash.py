@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# Content hashing of directory trees, for detecting changes between
+# builds.
+#
+# Hashing file content is what takes time, so file digests are computed
+# in parallel and remembered in an optional cache file, keyed by path,
+# inode, mtime and size. Files which are unchanged according to that
+# key are not read again.
+#
+# Used by image-dsk.py, which runs with Python 2, and by bitbake
+# tasks, so this must work with both Python 2 and 3.
+#
+# Copyright (C) 2017 Intel Corporation
+# Licensed under the MIT license
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import os
+import stat
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+
+def to_bytes(name):
+    """File names are bytes in Python 2 and str in Python 3."""
+    if isinstance(name, bytes):
+        return name
+    return name.encode('utf-8', 'surrogateescape')
+
+
+_libc = None
+
+
+def xattrs(path):
+    """Return the sorted (name, value) pairs of the extended attributes
+    of path, without following symlinks.
+
+    Python 2 has no os.listxattr(), so this calls libc directly.
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.llistxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                                     ctypes.c_size_t]
+        _libc.llistxattr.restype = ctypes.c_ssize_t
+        _libc.lgetxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                                    ctypes.c_char_p, ctypes.c_size_t]
+        _libc.lgetxattr.restype = ctypes.c_ssize_t
+
+    def call(function, *args):
+        # Get the size first, then the data. Retry when the
+        # attributes changed in between.
+        while True:
+            size = function(*(args + (None, 0)))
+            if size > 0:
+                buf = ctypes.create_string_buffer(size)
+                size = function(*(args + (buf, size)))
+            if size >= 0:
+                return buf.raw[:size] if size else b''
+            err = ctypes.get_errno()
+            if err == errno.ERANGE:
+                continue
+            if err in (errno.ENOTSUP, errno.ENODATA):
+                return b''
+            raise OSError(err, os.strerror(err), path)
+
+    path = to_bytes(path)
+    names = [name for name in call(_libc.llistxattr, path).split(b'\0')
+             if name]
+    return sorted([(name, call(_libc.lgetxattr, path, name))
+                   for name in names])
+
+
+def sha256_file(path):
+    """Return the sha256 hex digest of the content of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TreeHash(object):
+    """Computes digests of files and directory trees.
+
+    With cache_file, file digests get loaded from and saved to that file
+    (see save()). Only entries for files hashed since loading are saved,
+    so the cache does not grow with files which do not exist anymore.
+    """
+
+    def __init__(self, cache_file=None, jobs=None):
+        self.cache_file = cache_file
+        self.jobs = jobs or cpu_count()
+        self.cache = {}
+        self.used = {}
+        if cache_file:
+            try:
+                with open(cache_file) as f:
+                    self.cache = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def lookup(self, path, st):
+        """Return the cached digest of a file, None if unknown or modified."""
+        entry = self.used.get(path) or self.cache.get(path)
+        if entry and entry[:3] == [st.st_ino, st.st_mtime, st.st_size]:
+            self.used[path] = entry
+            return entry[3]
+        return None
+
+    def file_digests(self, files):
+        """Return the content digests of (path, stat) pairs, in order."""
+        digests = [self.lookup(path, st) for path, st in files]
+        missing = [i for i, digest in enumerate(digests) if digest is None]
+        if len(missing) > 1 and self.jobs > 1:
+            # hashlib releases the GIL while hashing, so threads
+            # are enough to use several CPUs.
+            pool = ThreadPool(min(self.jobs, len(missing)))
+            try:
+                computed = pool.map(sha256_file,
+                                    [files[i][0] for i in missing])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            computed = [sha256_file(files[i][0]) for i in missing]
+        for i, digest in zip(missing, computed):
+            path, st = files[i]
+            self.used[path] = [st.st_ino, st.st_mtime, st.st_size, digest]
+            digests[i] = digest
+        return digests
+
+    def file_hashes(self, paths):
+        """Return the digests of the content of files, in order."""
+        paths = [os.path.abspath(path) for path in paths]
+        return self.file_digests([(path, os.stat(path)) for path in paths])
+
+    def tree_hash(self, path):
+        """Return the digest of a directory tree or file.
+
+        Names, types, permissions, ownership, time stamps, extended
+        attributes, device numbers, hardlinks and content are covered.
+        Symlinks are not followed. An empty path has the digest of an
+        empty tree.
+        """
+        digest = hashlib.sha256()
+        if not path:
+            return digest.hexdigest()
+        path = os.path.abspath(path)
+        entries = [('.', path, os.lstat(path))]
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in dirs + sorted(files):
+                fullname = os.path.join(root, name)
+                entries.append((os.path.relpath(fullname, path), fullname,
+                                os.lstat(fullname)))
+        regular = [(fullname, st) for name, fullname, st in entries
+                   if stat.S_ISREG(st.st_mode)]
+        contents = iter(self.file_digests(regular))
+        # Hardlinked entries refer to the first name of their inode.
+        links = {}
+        for name, fullname, st in entries:
+            digest.update(to_bytes(name) + b'\0')
+            digest.update(('%o\0%d\0%d\0%d\0%d\0' %
+                           (st.st_mode, st.st_uid, st.st_gid,
+                            st.st_size, int(st.st_mtime))).encode('ascii'))
+            for attr, value in xattrs(fullname):
+                digest.update(b'xattr\0' + attr + b'\0' +
+                              ('%d\0' % len(value)).encode('ascii') + value)
+            if not stat.S_ISDIR(st.st_mode) and st.st_nlink > 1:
+                first = links.setdefault((st.st_dev, st.st_ino), name)
+                digest.update(b'link\0' + to_bytes(first) + b'\0')
+            if stat.S_ISLNK(st.st_mode):
+                digest.update(to_bytes(os.readlink(fullname)) + b'\0')
+            elif stat.S_ISREG(st.st_mode):
+                digest.update(next(contents).encode('ascii'))
+            elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                digest.update(('%d\0' % st.st_rdev).encode('ascii'))
+        return digest.hexdigest()
+
+    def save(self):
+        """Write the digests of all files hashed so far to the cache file."""
+        if not self.cache_file:
+            return
+        tmp = self.cache_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.used, f)
+        os.rename(tmp, self.cache_file)